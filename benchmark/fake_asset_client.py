@@ -0,0 +1,420 @@
+"""
+A local stand in for asset_v1.AssetServiceClient that serves the search
+and analysis calls from json exports, with injectable latency, so the
+remote mode can be benchmarked offline
+"""
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import PermissionDenied
+from google.cloud import asset_v1
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # pylint: disable=wrong-import-position
+
+
+class FakePage:
+    """
+    A page of search results, with the token of the next page (empty on
+    the last page)
+    """
+
+    def __init__(self, results, next_page_token=''):
+        self.results = results
+        self.next_page_token = next_page_token
+
+
+class FakePager:
+    """
+    Mimic the search pagers of the client library, the results can be
+    iterated one at a time or a page at a time
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page.results
+
+
+class FakeOperation:
+    """
+    A long running operation that is already done
+    """
+
+    def result(self, timeout=None):
+        """Return the (empty) result of the operation"""
+        del timeout
+
+
+class FakeBlob:
+    """
+    A storage object kept as a file in a local directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.content_encoding = None
+
+    def open(self, mode, **kwargs):
+        """Open the object, the upload options are ignored"""
+        del kwargs
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode)
+
+    def upload_from_string(self, contents, content_type=None):
+        """Replace the contents of the object"""
+        del content_type
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+        with self.open('wb') as blob_handler:
+            blob_handler.write(contents)
+
+    def download_as_bytes(self):
+        """Return the contents of the object"""
+        if not os.path.exists(self.path):
+            raise NotFound(self.path)
+        with open(self.path, 'rb') as blob_handler:
+            return blob_handler.read()
+
+    def delete(self):
+        """Delete the object"""
+        if not os.path.exists(self.path):
+            raise NotFound(self.path)
+        os.remove(self.path)
+
+
+class FakeStorageClient:
+    """
+    A stand in for storage.Client that keeps the objects in a local
+    directory, one sub directory per bucket
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def bucket(self, bucket_name):
+        """Return the bucket, which only hands out blobs"""
+        return FakeBucket(os.path.join(self.directory, bucket_name))
+
+
+class FakeBucket:
+    """
+    A bucket of the fake storage client
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def blob(self, object_name):
+        """Return an object of the bucket"""
+        return FakeBlob(
+            os.path.join(self.directory, object_name.replace('/', '_')))
+
+
+class FakeAssetServiceClient:
+    """
+    Serve search_all_iam_policies, search_all_resources and
+    analyze_iam_policy from an iam policy export and a service account
+    export (the same files local mode reads). Every result page and every
+    analysis call sleeps for the given latency. Users are made members of
+    one of the groups found in the policies (picked by a checksum of the
+    email) so the analysis also returns group inherited entitlements. The
+    org wide analysis is written through the passed in storage client.
+    Searches can be scoped to a project or folder of the export (the
+    projects and folders are listed from the export too) and the searches
+    in fail_scopes raise PermissionDenied
+    """
+
+    def __init__(self,
+                 iam_json_filename,
+                 sas_json_filename,
+                 latency=0.0,
+                 analysis_latency=None,
+                 page_size=500,
+                 storage_client=None,
+                 fail_scopes=()):
+        self.iam_json_filename = iam_json_filename
+        self.sas_json_filename = sas_json_filename
+        self.latency = latency
+        self.analysis_latency = (latency if analysis_latency is None else
+                                 analysis_latency)
+        self.page_size = page_size
+        self.storage_client = storage_client
+        self.fail_scopes = frozenset(fail_scopes)
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._principal_bindings = None
+        self._groups = None
+        self._records = {}
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def _iter_pages(self, method, results, page_token=None):
+        """
+        Yield the results a page at a time, sleeping for the latency before
+        each page. The page tokens are the page numbers, a search started
+        from a token skips the pages before it
+        """
+        page_number = int(page_token) if page_token else 0
+        results = iter(results)
+        next(
+            itertools.islice(results, page_number * self.page_size,
+                             page_number * self.page_size), None)
+        page_results = list(itertools.islice(results, self.page_size))
+        while page_results:
+            page_number += 1
+            next_results = list(itertools.islice(results, self.page_size))
+            self._count(method)
+            time.sleep(self.latency)
+            yield FakePage(page_results,
+                           str(page_number) if next_results else '')
+            page_results = next_results
+
+    def _scope_index(self, json_filename):
+        """
+        Index the records of an export by the projects and folders they are
+        in, the first search of a narrower scope builds the index
+        """
+        with self._lock:
+            if json_filename not in self._records:
+                index = collections.defaultdict(list)
+                for record in main.iter_json_records(json_filename):
+                    for scope in [record.get('project')] + record.get(
+                            'folders', []):
+                        if scope:
+                            index[scope].append(record)
+                self._records[json_filename] = index
+            return self._records[json_filename]
+
+    def _iter_records(self, json_filename, request):
+        """
+        Yield the records of an export that are in the scope and of the
+        asset types of a search request. An org scope is streamed from the
+        file, the records are kept in memory for the narrower scopes
+        """
+        scope = request['scope']
+        if scope in self.fail_scopes:
+            raise PermissionDenied(f"Fake permission denied on {scope}")
+        if scope.startswith('organizations/'):
+            records = main.iter_json_records(json_filename)
+        else:
+            records = self._scope_index(json_filename).get(scope, ())
+        asset_types = request.get('asset_types')
+        for record in records:
+            asset_type = record.get('assetType', record.get('asset_type'))
+            if asset_types and asset_type and asset_type not in asset_types:
+                continue
+            yield record
+
+    def search_all_iam_policies(self, request, retry=None, **kwargs):
+        """
+        Return the policies of the export as IamPolicySearchResults
+        """
+        del retry, kwargs
+        results = (asset_v1.IamPolicySearchResult(
+            asset_type=iam_policy.get('assetType',
+                                      iam_policy.get('asset_type')),
+            resource=iam_policy['resource'],
+            project=iam_policy.get('project', ''),
+            policy=iam_policy.get('policy') or {}) for iam_policy in
+                   self._iter_records(self.iam_json_filename, request))
+        return FakePager(
+            self._iter_pages('search_all_iam_policies', results,
+                             request.get('page_token')))
+
+    def _iter_containers(self, request):
+        """
+        Yield the projects and folders of the export as
+        ResourceSearchResults, the projects are the ones with a project
+        policy and their parent is their first folder
+        """
+        asset_types = request.get('asset_types') or ()
+        folders = {}
+        for iam_policy in main.iter_json_records(self.iam_json_filename):
+            parent = iam_policy.get('organization', '')
+            for folder in iam_policy.get('folders', ()):
+                folders.setdefault(folder, parent)
+                parent = folder
+            if (iam_policy.get('assetType') == main.PROJECT_ASSET_TYPE and
+                    main.PROJECT_ASSET_TYPE in asset_types):
+                yield asset_v1.ResourceSearchResult(
+                    name=iam_policy['resource'],
+                    asset_type=main.PROJECT_ASSET_TYPE,
+                    project=iam_policy.get('project', ''),
+                    parent_full_resource_name=(
+                        f"{main.RESOURCE_MANAGER_PREFIX}"
+                        f"{(iam_policy.get('folders') or [parent])[0]}"),
+                    state='ACTIVE')
+        if main.FOLDER_ASSET_TYPE in asset_types:
+            for folder, parent in sorted(folders.items()):
+                yield asset_v1.ResourceSearchResult(
+                    name=f"{main.RESOURCE_MANAGER_PREFIX}{folder}",
+                    asset_type=main.FOLDER_ASSET_TYPE,
+                    parent_full_resource_name=(
+                        f"{main.RESOURCE_MANAGER_PREFIX}{parent}"),
+                    state='ACTIVE')
+
+    def search_all_resources(self, request, retry=None, **kwargs):
+        """
+        Return the service accounts of the export as ResourceSearchResults,
+        or its projects and folders if those are searched for
+        """
+        del retry, kwargs
+        if set(request.get('asset_types') or
+               ()) & {main.PROJECT_ASSET_TYPE, main.FOLDER_ASSET_TYPE}:
+            return FakePager(
+                self._iter_pages('search_all_resources',
+                                 self._iter_containers(request),
+                                 request.get('page_token')))
+        results = (asset_v1.ResourceSearchResult(
+            name=svc_account.get('name', ''),
+            asset_type='iam.googleapis.com/ServiceAccount',
+            additional_attributes=svc_account.get(
+                'additionalAttributes',
+                svc_account.get('additional_attributes')))
+                   for svc_account in self._iter_records(
+                       self.sas_json_filename,
+                       dict(request,
+                            asset_types=['iam.googleapis.com/ServiceAccount'])))
+        return FakePager(
+            self._iter_pages('search_all_resources', results,
+                             request.get('page_token')))
+
+    def _load_principal_bindings(self):
+        """
+        Index the bindings of the export by member, the first analysis call
+        builds the index
+        """
+        with self._lock:
+            if self._principal_bindings is not None:
+                return
+            principal_bindings = collections.defaultdict(list)
+            for iam_policy in map(
+                    main.policy_record_from_dict,
+                    main.iter_json_records(self.iam_json_filename)):
+                for binding in iam_policy.bindings:
+                    for member in binding.members:
+                        if member.startswith(('user:', 'group:')):
+                            principal_bindings[member].append(
+                                (iam_policy.resource, binding.role))
+            self._groups = sorted(member for member in principal_bindings
+                                  if member.startswith('group:'))
+            self._principal_bindings = principal_bindings
+
+    def _group_of(self, identity):
+        """
+        The group a user is a member of, or None if there are no groups
+        """
+        if not self._groups:
+            return None
+        return self._groups[zlib.crc32(identity.encode()) % len(self._groups)]
+
+    def analyze_iam_policy(self, request, retry=None, **kwargs):
+        """
+        Return the direct and group inherited bindings of the identity in
+        the analysis query
+        """
+        del retry, kwargs
+        self._count('analyze_iam_policy')
+        time.sleep(self.analysis_latency)
+        self._load_principal_bindings()
+        identity = request['analysis_query'].identity_selector.identity
+        response = asset_v1.AnalyzeIamPolicyResponse()
+        results = response.main_analysis.analysis_results
+        for resource, role in self._principal_bindings.get(identity, ()):
+            results.append(
+                asset_v1.IamPolicyAnalysisResult(
+                    attached_resource_full_name=resource,
+                    iam_binding={
+                        'role': role,
+                        'members': [identity]
+                    },
+                    identity_list={'identities': [{
+                        'name': identity
+                    }]}))
+        group = self._group_of(identity)
+        if group is not None:
+            for resource, role in self._principal_bindings[group]:
+                results.append(
+                    asset_v1.IamPolicyAnalysisResult(
+                        attached_resource_full_name=resource,
+                        iam_binding={
+                            'role': role,
+                            'members': [group]
+                        },
+                        identity_list={
+                            'identities': [{
+                                'name': identity
+                            }],
+                            'group_edges': [{
+                                'source_node': group,
+                                'target_node': identity
+                            }]
+                        }))
+        return response
+
+    def analyze_iam_policy_longrunning(self, request, retry=None, **kwargs):
+        """
+        Write the org wide analysis to the gcs destination of the request,
+        one result per binding that reaches a user (directly or through
+        their group), as json lines
+        """
+        del retry, kwargs
+        self._count('analyze_iam_policy_longrunning')
+        time.sleep(self.analysis_latency)
+        self._load_principal_bindings()
+        group_members = collections.defaultdict(list)
+        for member in self._principal_bindings:
+            if member.startswith('user:'):
+                group_members[self._group_of(member)].append(member)
+
+        lines = []
+        for iam_policy in map(main.policy_record_from_dict,
+                              main.iter_json_records(self.iam_json_filename)):
+            for binding in iam_policy.bindings:
+                identities = [
+                    member for member in binding.members
+                    if member.startswith('user:')
+                ]
+                group_edges = []
+                for group in binding.members:
+                    for member in group_members.get(group, ()):
+                        group_edges.append({
+                            'sourceNode': group,
+                            'targetNode': member
+                        })
+                        if member not in identities:
+                            identities.append(member)
+                if not identities:
+                    continue
+                lines.append(
+                    json.dumps({
+                        'attachedResourceFullName': iam_policy.resource,
+                        'iamBinding': {
+                            'role': binding.role,
+                            'members': list(binding.members)
+                        },
+                        'identityList': {
+                            'identities': [{
+                                'name': identity
+                            } for identity in identities],
+                            'groupEdges': group_edges
+                        },
+                        'fullyExplored': True
+                    }))
+        gcp_bucket, object_name = main.split_gcs_uri(
+            request['output_config'].gcs_destination.uri)
+        self.storage_client.bucket(gcp_bucket).blob(
+            object_name).upload_from_string('\n'.join(lines))
+        return FakeOperation()
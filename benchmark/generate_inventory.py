@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic asset inventory export, in the same format as the
+output of `gcloud asset search-all-iam-policies` and
+`gcloud asset search-all-resources --asset-types=iam.googleapis.com/ServiceAccount`,
+at a configurable scale
+"""
+import argparse
+import codecs
+import json
+import random
+
+ORG_ID = "123456789012"
+DOMAIN = "example.com"
+
+## Roles handed out on projects, the first ones are the most common
+PROJECT_ROLES = [
+    'roles/viewer', 'roles/editor', 'roles/owner', 'roles/browser',
+    'roles/compute.admin', 'roles/compute.viewer', 'roles/storage.admin',
+    'roles/storage.objectViewer', 'roles/bigquery.dataViewer',
+    'roles/bigquery.jobUser', 'roles/logging.logWriter',
+    'roles/monitoring.metricWriter', 'roles/iam.serviceAccountUser',
+    'roles/container.developer', 'roles/pubsub.publisher',
+    'roles/cloudsql.client', 'roles/secretmanager.secretAccessor'
+]
+
+## Resources with their own policies and the roles used on them
+RESOURCE_TYPES = [
+    ('storage.googleapis.com/Bucket',
+     '//storage.googleapis.com/{project}-bucket-{index}', [
+         'roles/storage.objectViewer', 'roles/storage.objectAdmin',
+         'roles/storage.legacyBucketReader'
+     ]),
+    ('bigquery.googleapis.com/Dataset',
+     '//bigquery.googleapis.com/projects/{project}/datasets/dataset_{index}', [
+         'roles/bigquery.dataViewer', 'roles/bigquery.dataEditor',
+         'roles/bigquery.dataOwner'
+     ]),
+    ('iam.googleapis.com/ServiceAccount',
+     '//iam.googleapis.com/projects/{project}/serviceAccounts/sa-{index}@{project}.iam.gserviceaccount.com',
+     ['roles/iam.serviceAccountUser', 'roles/iam.serviceAccountTokenCreator']),
+    ('pubsub.googleapis.com/Topic',
+     '//pubsub.googleapis.com/projects/{project}/topics/topic-{index}',
+     ['roles/pubsub.publisher', 'roles/pubsub.subscriber'])
+]
+
+## How many bindings a project or resource policy holds at most
+BINDINGS_PER_POLICY = 8
+
+
+def project_id(project):
+    """
+    Name of the nth synthetic project
+    """
+    return f"proj-{project:06d}"
+
+
+def project_number(project):
+    """
+    Number of the nth synthetic project
+    """
+    return str(100000000000 + project)
+
+
+def sa_email(svc_account, projects):
+    """
+    Email of the nth synthetic service account, the accounts are spread
+    round robin over the projects
+    """
+    return (f"sa-{svc_account // projects}@"
+            f"{project_id(svc_account % projects)}.iam.gserviceaccount.com")
+
+
+def pick_members(rng,
+                 project,
+                 projects,
+                 service_accounts,
+                 users,
+                 groups,
+                 max_members=None):
+    """
+    Pick the members of a binding, mostly accounts of the project itself,
+    with some users, groups, service agents and special members mixed in.
+    Bindings have 1 to 3 members, or up to max_members if it's passed
+    """
+    if max_members:
+        member_count = rng.randint(1, max_members)
+    else:
+        member_count = rng.choice((1, 1, 1, 2, 2, 3))
+    members = []
+    for _ in range(member_count):
+        kind = rng.random()
+        if kind < 0.45 and service_accounts > projects:
+            svc_account = project + projects * rng.randrange(
+                max(1, service_accounts // projects))
+            member = f"serviceAccount:{sa_email(svc_account, projects)}"
+            if rng.random() < 0.01:
+                member = f"deleted:{member}?uid={svc_account}"
+        elif kind < 0.75 and users:
+            member = f"user:user{rng.randrange(users)}@{DOMAIN}"
+        elif kind < 0.85 and groups:
+            member = f"group:group{rng.randrange(groups)}@{DOMAIN}"
+        elif kind < 0.95:
+            member = (f"serviceAccount:service-{project_number(project)}"
+                      f"@compute-system.iam.gserviceaccount.com")
+        elif kind < 0.98:
+            member = f"projectOwner:{project_id(project)}"
+        else:
+            member = "allAuthenticatedUsers"
+        if member not in members:
+            members.append(member)
+    return members
+
+
+def make_policy(asset_type, resource, project, bindings):
+    """
+    Create a policy search result the way gcloud prints it
+    """
+    return {
+        "assetType": asset_type,
+        "folders": [f"folders/{300000000000 + project % 97}"],
+        "organization": f"organizations/{ORG_ID}",
+        "policy": {
+            "bindings": bindings
+        },
+        "project": f"projects/{project_number(project)}",
+        "resource": resource
+    }
+
+
+def iter_synthetic_policies(projects,
+                            service_accounts,
+                            bindings,
+                            users,
+                            groups,
+                            seed=0,
+                            max_members=None):
+    """
+    Yield synthetic iam policy search results, every project gets a project
+    policy and its share of the bindings is spread over resource policies
+    (buckets, datasets, service accounts and topics)
+    """
+    rng = random.Random(seed)
+    for project in range(projects):
+        project_bindings = bindings // projects
+        if project < bindings % projects:
+            project_bindings += 1
+        resource_index = 0
+        while project_bindings > 0:
+            if resource_index == 0:
+                asset_type = "cloudresourcemanager.googleapis.com/Project"
+                resource = (f"//cloudresourcemanager.googleapis.com/projects/"
+                            f"{project_id(project)}")
+                roles = PROJECT_ROLES
+            else:
+                asset_type, resource_format, roles = rng.choice(RESOURCE_TYPES)
+                resource = resource_format.format(project=project_id(project),
+                                                  index=resource_index)
+            resource_index += 1
+            ## A policy has at most one binding per role
+            policy_bindings = min(project_bindings,
+                                  rng.randint(1, BINDINGS_PER_POLICY),
+                                  len(roles))
+            project_bindings -= policy_bindings
+            policy = make_policy(asset_type, resource, project, [])
+            for role in rng.sample(roles, policy_bindings):
+                members = pick_members(rng, project, projects, service_accounts,
+                                       users, groups, max_members)
+                policy["policy"]["bindings"].append({
+                    "members": members,
+                    "role": role
+                })
+            yield policy
+
+
+def iter_synthetic_sas(projects, service_accounts):
+    """
+    Yield synthetic service account resource search results
+    """
+    for svc_account in range(service_accounts):
+        project = svc_account % projects
+        email = sa_email(svc_account, projects)
+        yield {
+            "additionalAttributes": {
+                "email": email,
+                "uniqueId": str(100000000000000000000 + svc_account)
+            },
+            "assetType": "iam.googleapis.com/ServiceAccount",
+            "displayName": email.split('@')[0],
+            "folders": [f"folders/{300000000000 + project % 97}"],
+            "name": (f"//iam.googleapis.com/projects/{project_id(project)}/"
+                     f"serviceAccounts/{email}"),
+            "organization": f"organizations/{ORG_ID}",
+            "parentAssetType": "cloudresourcemanager.googleapis.com/Project",
+            "parentFullResourceName":
+                (f"//cloudresourcemanager.googleapis.com/projects/"
+                 f"{project_id(project)}"),
+            "project": f"projects/{project_number(project)}",
+            "state": "ENABLED"
+        }
+
+
+def write_json_records(records, filename, encoding='utf-8', json_lines=False):
+    """
+    Write the records to a json file one at a time, either as a json array
+    indented like gcloud does or as json lines. utf-16-le files get a BOM
+    and windows line endings, like a powershell redirect produces. Returns
+    the number of records written
+    """
+    newline = '\r\n' if encoding == 'utf-16-le' else '\n'
+    count = 0
+    with open(filename, 'w', encoding=encoding,
+              newline=newline) as json_file_handler:
+        if encoding == 'utf-16-le':
+            json_file_handler.write(codecs.BOM_UTF16_LE.decode('utf-16-le'))
+        if not json_lines:
+            json_file_handler.write('[\n')
+        for record in records:
+            if json_lines:
+                json_file_handler.write(json.dumps(record))
+                json_file_handler.write('\n')
+            else:
+                if count:
+                    json_file_handler.write(',\n')
+                json_file_handler.write(json.dumps(record, indent=2))
+            count += 1
+        if not json_lines:
+            json_file_handler.write('\n]\n')
+    return count
+
+
+def generate_inventory(iam_filename,
+                       sas_filename,
+                       projects,
+                       service_accounts,
+                       bindings,
+                       users,
+                       groups,
+                       encoding='utf-8',
+                       json_lines=False,
+                       seed=0,
+                       max_members=None):
+    """
+    Write a synthetic iam policy export and service account export, returns
+    the number of policies and service accounts written
+    """
+    policies = write_json_records(
+        iter_synthetic_policies(projects, service_accounts, bindings, users,
+                                groups, seed, max_members), iam_filename,
+        encoding, json_lines)
+    svc_accounts = write_json_records(
+        iter_synthetic_sas(projects, service_accounts), sas_filename, encoding,
+        json_lines)
+    return policies, svc_accounts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=(
+        "Generate a synthetic asset inventory export to benchmark main.py"))
+    parser.add_argument('-i',
+                        '--iam_file',
+                        default='bench-iam-policies.json',
+                        help='iam policies file to write')
+    parser.add_argument('-s',
+                        '--sas_file',
+                        default='bench-sas.json',
+                        help='service accounts file to write')
+    parser.add_argument('--projects',
+                        type=int,
+                        default=1000,
+                        help='number of projects (default 1000)')
+    parser.add_argument('--service_accounts',
+                        type=int,
+                        default=10000,
+                        help='number of service accounts (default 10000)')
+    parser.add_argument('--bindings',
+                        type=int,
+                        default=100000,
+                        help='total number of role bindings (default 100000)')
+    parser.add_argument('--users',
+                        type=int,
+                        default=2000,
+                        help='number of distinct users (default 2000)')
+    parser.add_argument('--groups',
+                        type=int,
+                        default=200,
+                        help='number of distinct groups (default 200)')
+    parser.add_argument('--encoding',
+                        choices=['utf-8', 'utf-16-le'],
+                        default='utf-8',
+                        help='encoding of the files (default utf-8)')
+    parser.add_argument('--json_lines',
+                        action='store_true',
+                        help='write json lines instead of a json array')
+    parser.add_argument('--max_members',
+                        type=int,
+                        help='members per binding picked from 1 up to this '
+                        '(default 1 to 3, mostly 1)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed, the same seed gives the same files')
+    args = parser.parse_args()
+    counts = generate_inventory(args.iam_file, args.sas_file, args.projects,
+                                args.service_accounts, args.bindings,
+                                args.users, args.groups, args.encoding,
+                                args.json_lines, args.seed, args.max_members)
+    print(f"Wrote {counts[0]} policies to {args.iam_file} and "
+          f"{counts[1]} service accounts to {args.sas_file}")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Benchmark the parsing of an asset inventory export, in local mode straight
+from the json files and in remote mode through a fake asset client.
+Reports the time, throughput and peak RSS of every stage
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # pylint: disable=wrong-import-position
+from fake_asset_client import FakeAssetServiceClient  # pylint: disable=wrong-import-position
+from fake_asset_client import FakeStorageClient  # pylint: disable=wrong-import-position
+from generate_inventory import generate_inventory  # pylint: disable=wrong-import-position
+
+ORG_ID = "123456789012"
+
+
+def peak_rss_mib():
+    """
+    Peak resident set size of the process so far in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Linux reports KiB, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class StageTimer:
+    """
+    Collect the timings of the benchmark stages
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Run a stage and record its time and the peak RSS after it. The stage
+        returns its result and the number of items it processed
+        """
+        start = time.perf_counter()
+        result, items = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.stages.append({
+            'stage': name,
+            'seconds': round(seconds, 3),
+            'items': items,
+            'items_per_second': round(items / seconds) if seconds else None,
+            'peak_rss_mib': round(peak_rss_mib(), 1)
+        })
+        return result
+
+    def run_best_of(self, name, repeat, func, *args, **kwargs):
+        """
+        Run a stage repeat times and only keep the timing of the fastest
+        run, so small changes can be compared on a noisy machine
+        """
+        best = None
+        for _ in range(max(1, repeat)):
+            result = self.run(name, func, *args, **kwargs)
+            stage = self.stages.pop()
+            if best is None or stage['seconds'] < best['seconds']:
+                best = stage
+        self.stages.append(best)
+        return result
+
+    def report(self):
+        """
+        Print the timings as a table
+        """
+        print(f"{'stage':<16}{'seconds':>10}{'items':>12}{'items/s':>12}"
+              f"{'peak RSS MiB':>14}")
+        for stage in self.stages:
+            print(f"{stage['stage']:<16}{stage['seconds']:>10.3f}"
+                  f"{stage['items']:>12}{stage['items_per_second'] or 0:>12}"
+                  f"{stage['peak_rss_mib']:>14.1f}")
+
+
+def count_bindings(all_iam_policies):
+    """
+    Total number of role bindings in a list of PolicyRecords
+    """
+    return sum(len(iam_policy.bindings) for iam_policy in all_iam_policies)
+
+
+def load_local(iam_json_filename, sas_json_filename, workers=1):
+    """
+    Load the json exports into records, the items are the bindings. With
+    more than one worker only the service accounts are loaded, the worker
+    processes read the policies from the file during the parse stage
+    """
+    all_svc_accts = [
+        sa_record
+        for sa_record in map(main.sa_record_from_dict,
+                             main.import_json_as_dictionary(sas_json_filename))
+        if sa_record is not None
+    ]
+    if workers > 1:
+        return (iam_json_filename, all_svc_accts), 0
+    all_iam_policies = [
+        main.policy_record_from_dict(iam_policy)
+        for iam_policy in main.import_json_as_dictionary(iam_json_filename)
+    ]
+    return (all_iam_policies, all_svc_accts), count_bindings(all_iam_policies)
+
+
+def fetch_remote(org_id, search_scopes):
+    """
+    Fetch the policies and service accounts through the asset client, the
+    items are the bindings
+    """
+    all_iam_policies = main.get_all_iam_policies(org_id,
+                                                 search_scopes=search_scopes)
+    all_svc_accts = main.get_all_sas(org_id, search_scopes=search_scopes)
+    return (all_iam_policies, all_svc_accts), count_bindings(all_iam_policies)
+
+
+def export_analysis(org_id, gcs_uri):
+    """
+    Run the org wide analysis export and load it, the items are the users
+    """
+    main.export_org_analysis(org_id, gcs_uri)
+    org_analysis = main.load_org_analysis(gcs_uri)
+    main.set_org_analysis(org_analysis)
+    return org_analysis, len(org_analysis.entitlements)
+
+
+def parse(records, org_id, workers, analysis_workers):
+    """
+    Parse the records into principal policies, the items are the principals.
+    With more than one worker the policies are the name of the export
+    """
+    all_iam_policies, all_svc_accts = records
+    if workers > 1:
+        principal_policies = main.parse_assets_output_parallel(
+            all_iam_policies, all_svc_accts, workers)
+    else:
+        principal_policies = main.parse_assets_output(all_iam_policies,
+                                                      all_svc_accts, org_id,
+                                                      analysis_workers)
+    return principal_policies, len(principal_policies)
+
+
+def write(principal_policies, filename, output_format):
+    """
+    Write out the principal policies, the items are the principals
+    """
+    main.write_results(principal_policies.values(), filename, output_format)
+    return None, len(principal_policies)
+
+
+def run_benchmark(iam_json_filename, sas_json_filename, output_filename,
+                  temp_dir, args):
+    """
+    Run the stages of the selected mode and return their timings
+    """
+    timer = StageTimer()
+    if args.mode == 'remote':
+        fake_client = FakeAssetServiceClient(
+            iam_json_filename,
+            sas_json_filename,
+            latency=args.latency,
+            analysis_latency=args.analysis_latency,
+            page_size=args.page_size,
+            storage_client=FakeStorageClient(temp_dir))
+        main.set_client_provider(
+            main.ClientProvider(asset_client=fake_client,
+                                storage_client=fake_client.storage_client))
+        records = timer.run(
+            'fetch', fetch_remote, ORG_ID,
+            main.SearchScopes(ORG_ID, args.scope_mode, args.scope_workers))
+        if args.analysis_mode == 'org_export':
+            timer.run('export_analysis', export_analysis, ORG_ID,
+                      'gs://bench/iam-policy-analysis.json')
+        org_id = ORG_ID
+        ## The worker processes only parse local exports
+        workers = 1
+    else:
+        fake_client = None
+        records = timer.run('load', load_local, iam_json_filename,
+                            sas_json_filename, args.workers)
+        org_id = None
+        workers = args.workers
+    principal_policies = timer.run_best_of('parse', args.repeat, parse, records,
+                                           org_id, workers,
+                                           args.analysis_workers)
+    timer.run('write', write, principal_policies, output_filename,
+              args.output_format)
+    return timer, fake_client
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=(
+        "Benchmark main.py on a synthetic (or the passed in) asset inventory "
+        "export"))
+    parser.add_argument('-m',
+                        '--mode',
+                        choices=['local', 'remote'],
+                        default='local',
+                        help='local reads the json files, remote goes through '
+                        'a fake asset client (default local)')
+    parser.add_argument('-i',
+                        '--iam_file',
+                        help='iam policies export, generated if not passed')
+    parser.add_argument('-s',
+                        '--sas_file',
+                        help='service accounts export, generated if not passed')
+    parser.add_argument('--projects', type=int, default=1000)
+    parser.add_argument('--service_accounts', type=int, default=10000)
+    parser.add_argument('--bindings', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--max_members',
+                        type=int,
+                        help='members per binding picked from 1 up to this '
+                        '(default 1 to 3, mostly 1)')
+    parser.add_argument('--encoding',
+                        choices=['utf-8', 'utf-16-le'],
+                        default='utf-8',
+                        help='encoding of the generated files (default utf-8)')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=1,
+                        help='processes used to parse in local mode')
+    parser.add_argument('--analysis_workers',
+                        type=int,
+                        default=main.ANALYSIS_CONCURRENCY,
+                        help='concurrent analysis calls in remote mode')
+    parser.add_argument('--analysis_mode',
+                        choices=main.ANALYSIS_MODES,
+                        default='per_user',
+                        help='how the users are analyzed in remote mode '
+                        '(default per_user)')
+    parser.add_argument('--scope_mode',
+                        choices=main.SCOPE_MODES,
+                        default='org',
+                        help='search the whole org at once or fan out over '
+                        'its folders or projects in remote mode (default org)')
+    parser.add_argument('--scope_workers',
+                        type=int,
+                        default=main.SCOPE_CONCURRENCY,
+                        help='concurrent scope searches in remote mode')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='seconds the fake client sleeps per result page')
+    parser.add_argument('--analysis_latency',
+                        type=float,
+                        help='seconds the fake client sleeps per analysis '
+                        'call (default the same as --latency)')
+    parser.add_argument('--page_size',
+                        type=int,
+                        default=500,
+                        help='results per page of the fake client')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='run the parse stage this many times and report '
+                        'the fastest run (default 1)')
+    parser.add_argument('-f',
+                        '--output_format',
+                        choices=main.OUTPUT_FORMATS,
+                        default='csv')
+    parser.add_argument('--json',
+                        help='also write the results as json to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        iam_json_filename = args.iam_file
+        sas_json_filename = args.sas_file
+        if not iam_json_filename or not sas_json_filename:
+            iam_json_filename = os.path.join(temp_dir, 'iam-policies.json')
+            sas_json_filename = os.path.join(temp_dir, 'sas.json')
+            start = time.perf_counter()
+            generate_inventory(iam_json_filename,
+                               sas_json_filename,
+                               args.projects,
+                               args.service_accounts,
+                               args.bindings,
+                               args.users,
+                               args.groups,
+                               args.encoding,
+                               max_members=args.max_members)
+            print(f"Generated the export in "
+                  f"{time.perf_counter() - start:.1f}s")
+        output_filename = os.path.join(temp_dir, f"out.{args.output_format}")
+        timer, fake_client = run_benchmark(iam_json_filename, sas_json_filename,
+                                           output_filename, temp_dir, args)
+        output_size = os.path.getsize(output_filename)
+
+    timer.report()
+    total = sum(stage['seconds'] for stage in timer.stages)
+    print(f"total {total:.3f}s, output {output_size / (1024 * 1024):.1f} MiB")
+    if fake_client is not None:
+        print(f"api calls: {dict(fake_client.calls)}")
+    if args.json:
+        with open(args.json, 'w') as json_file_handler:
+            json.dump(
+                {
+                    'mode': args.mode,
+                    'stages': timer.stages,
+                    'total_seconds': round(total, 3),
+                    'output_bytes': output_size,
+                    'api_calls': dict(fake_client.calls) if fake_client else {}
+                },
+                json_file_handler,
+                indent=2)
@@ -4,46 +4,1300 @@ Script to get a list of service accounts and their IAM policy
 with GCP asset inventory
 """
 import os
+import sys
 import json
 import codecs
 import csv
 import argparse
 import base64
+import contextlib
+import cProfile
+import io
+import signal
+import gzip
+import functools
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from itertools import count
+from itertools import filterfalse
+from itertools import islice
+from itertools import repeat
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
 # import re
 from google.cloud import asset_v1
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.api_core import retry as api_retry
 from google.api_core.exceptions import GoogleAPIError
-import proto
+from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import ServiceUnavailable
+from google.protobuf import field_mask_pb2
 import googleapiclient.errors
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    ## Only needed for the parquet output format
+    pyarrow = None
+try:
+    import resource
+except ImportError:
+    ## Not available on windows, the peak memory isn't reported there
+    resource = None
+try:
+    from opentelemetry import trace
+except ImportError:
+    ## The run metrics are also recorded as spans when opentelemetry
+    # is installed
+    trace = None
 
 
-def get_all_sas(org_id):
+class RunMetrics:
     """
-    Get a list of Service Account and return them as a list of dictionaries
+    Collect the wall time of the stages of a run and the number of API
+    calls, items, retries and errors per API method. Stage times can be
+    nested, for example the analysis is part of the parsing. The recording
+    methods are thread safe
     """
-    scope = f"organizations/{org_id}"
-    asset_types = ['iam.googleapis.com/ServiceAccount']
-    query = "NOT name:(sandbox OR nonprod)"
-    client = asset_v1.AssetServiceClient()
+
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = {}
+        self.api_calls = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._tracer = trace.get_tracer(__name__) if trace else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage, the time is added up if the stage runs more than once.
+        Yields the opentelemetry span of the stage, or None
+        """
+        span_context = (self._tracer.start_as_current_span(name)
+                        if self._tracer else contextlib.nullcontext())
+        start = time.perf_counter()
+        try:
+            with span_context as span:
+                yield span
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def _api_method(self, method):
+        return self.api_calls.setdefault(
+            method, {
+                'calls': 0,
+                'items': 0,
+                'seconds': 0.0,
+                'retries': 0,
+                'errors': 0,
+                'throttled_seconds': 0.0
+            })
+
+    def record_api_call(self, method, items, seconds):
+        """
+        Record an API call (or a result page) returning items results
+        """
+        with self._lock:
+            api_method = self._api_method(method)
+            api_method['calls'] += 1
+            api_method['items'] += items
+            api_method['seconds'] += seconds
+
+    def record_retry(self, method):
+        """
+        Record a retried API call
+        """
+        with self._lock:
+            self._api_method(method)['retries'] += 1
+
+    def record_error(self, method):
+        """
+        Record an API call that failed for good
+        """
+        with self._lock:
+            self._api_method(method)['errors'] += 1
+
+    def record_throttle(self, method, seconds):
+        """
+        Record the time an API call waited for the quota
+        """
+        with self._lock:
+            self._api_method(method)['throttled_seconds'] += seconds
+
+    def summary(self):
+        """
+        Return the metrics as a dictionary, times are in seconds
+        """
+        with self._lock:
+            api_calls = {}
+            for method, api_method in self.api_calls.items():
+                api_calls[method] = dict(
+                    api_method,
+                    seconds=round(api_method['seconds'], 3),
+                    throttled_seconds=round(api_method['throttled_seconds'], 3))
+                if api_method['calls']:
+                    api_calls[method]['items_per_call'] = round(
+                        api_method['items'] / api_method['calls'], 1)
+            stages = {
+                name: round(seconds, 3) for name, seconds in self.stages.items()
+            }
+        peak_rss_mib = None
+        if resource is not None:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            ## Linux reports KiB, macOS bytes
+            if sys.platform == 'darwin':
+                peak_rss //= 1024
+            peak_rss_mib = round(peak_rss / 1024, 1)
+        return {
+            'severity': 'INFO',
+            'message': 'run metrics',
+            'run': self.name,
+            'wall_seconds': round(time.perf_counter() - self._start, 3),
+            'stages': stages,
+            'api_calls': api_calls,
+            'peak_rss_mib': peak_rss_mib
+        }
+
+    def emit(self, span=None):
+        """
+        Print the metrics as a single json log line (cloud logging turns it
+        into a structured entry) and add them to the span, if there is one
+        """
+        summary = self.summary()
+        print(json.dumps(summary))
+        if span is not None:
+            for name, seconds in summary['stages'].items():
+                span.set_attribute(f"stage.{name}.seconds", seconds)
+            for method, api_method in summary['api_calls'].items():
+                for key in ('calls', 'items', 'seconds', 'retries', 'errors',
+                            'throttled_seconds'):
+                    span.set_attribute(f"api.{method}.{key}", api_method[key])
+            if summary['peak_rss_mib'] is not None:
+                span.set_attribute('peak_rss_mib', summary['peak_rss_mib'])
+
+
+## Metrics of the current run, outside of a run they are collected but
+# never reported
+_RUN_METRICS = RunMetrics()
+
+
+def get_run_metrics():
+    """Return the metrics of the current run"""
+    return _RUN_METRICS
+
+
+def set_run_metrics(metrics):
+    """
+    Replace the metrics of the current run, returns the previous ones so
+    they can be restored
+    """
+    global _RUN_METRICS
+    previous = _RUN_METRICS
+    _RUN_METRICS = metrics
+    return previous
+
+
+@contextlib.contextmanager
+def instrumented_run(name, profile_location=None):
+    """
+    Collect the metrics of a run and emit them at the end, also when the
+    run fails, and drop the parse memos of the run. A run started inside
+    another run is only timed as a stage of the outer one. If a profile
+    location (local path or gs:// uri) is passed the run is profiled with
+    cProfile, only the calling thread is profiled
+    """
+    if get_run_metrics().name is not None:
+        with get_run_metrics().stage(name):
+            yield
+        return
+
+    metrics = RunMetrics(name)
+    previous = set_run_metrics(metrics)
+    profiler = cProfile.Profile() if profile_location else None
     try:
-        response = client.search_all_resources(request={
-            "scope": scope,
-            "query": query,
-            "asset_types": asset_types
-        })
-    except (GoogleAPIError, googleapiclient.errors.HttpError) as err:
-        print(f'API Error: {err}')
+        with metrics.stage(name) as span:
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                metrics.emit(span)
+    finally:
+        set_run_metrics(previous)
+        clear_parse_memos()
+        if profiler is not None:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                profile_file = os.path.join(temp_dir, 'run.prof')
+                profiler.dump_stats(profile_file)
+                with open(profile_file, 'rb') as profile_handler:
+                    write_bytes_to_location(profile_location,
+                                            profile_handler.read())
+            print(f"Wrote profile to {profile_location}")
+
+
+class RateLimiter:
+    """
+    Token bucket that lets through rate calls per second on average, with
+    bursts of up to burst calls. A caller that finds the bucket empty
+    reserves the next free slot, so the waiting callers are let through in
+    order. Thread safe
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a call is allowed, returns the seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class ApiQuota:
+    """
+    The rate limits of the asset API calls: qps calls per second over all
+    the orgs (the quota of the project the calls are billed to) and
+    org_qps calls per second per org. Either one can be None for no limit
+    """
+
+    def __init__(self, qps=None, org_qps=None):
+        self.qps = qps
+        self.org_qps = org_qps
+        self._limiter = RateLimiter(qps) if qps else None
+        self._org_limiters = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, org_id=None):
+        """
+        Wait until a call for the org is allowed, returns the seconds
+        waited. The org limit is waited for first so an org that is over
+        its limit doesn't hold up the others
+        """
+        waited = 0.0
+        if self.org_qps:
+            with self._lock:
+                limiter = self._org_limiters.get(org_id)
+                if limiter is None:
+                    limiter = RateLimiter(self.org_qps)
+                    self._org_limiters[org_id] = limiter
+            waited += limiter.acquire()
+        if self._limiter is not None:
+            waited += self._limiter.acquire()
+        return waited
+
+
+## Quota the API calls are held to, None when they aren't limited
+_API_QUOTA = None
+
+
+def get_api_quota():
+    """Return the quota of the API calls, or None"""
+    return _API_QUOTA
+
+
+def set_api_quota(quota):
+    """
+    Replace the quota of the API calls, returns the previous one so it can
+    be restored
+    """
+    global _API_QUOTA
+    previous = _API_QUOTA
+    _API_QUOTA = quota
+    return previous
+
+
+def throttle_api_call(method, org_id=None):
+    """
+    Wait until the API quota allows another call for the org, the time
+    waited is recorded in the run metrics
+    """
+    quota = get_api_quota()
+    if quota is not None:
+        waited = quota.acquire(org_id)
+        if waited:
+            get_run_metrics().record_throttle(method, waited)
+
+
+def iter_search_pages(response, method, request_seconds=0.0, org_id=None):
+    """
+    Yield the result pages of a search pager one at a time, recording every
+    page that is fetched in the run metrics. The first page comes with the
+    initial request, which took request_seconds, the requests of the next
+    pages are held to the API quota of the org
+    """
+    metrics = get_run_metrics()
+    pages = iter(response.pages)
+    start = time.perf_counter() - request_seconds
+    page = next(pages, None)
+    while page is not None:
+        metrics.record_api_call(method, len(page.results),
+                                time.perf_counter() - start)
+        yield page
+        if page.next_page_token:
+            throttle_api_call(method, org_id)
+        start = time.perf_counter()
+        page = next(pages, None)
+
+
+def iter_search_results(response, method, request_seconds=0.0, org_id=None):
+    """
+    Yield the results of a search pager one at a time, see
+    iter_search_pages
+    """
+    for page in iter_search_pages(response, method, request_seconds, org_id):
+        yield from page.results
+
+
+def record_analysis_retry(err):
+    """
+    Called by the analysis retry for every error it's going to retry
+    """
+    del err
+    get_run_metrics().record_retry('analyze_iam_policy')
+
+
+## Default number of analyze_iam_policy calls allowed in flight at once
+ANALYSIS_CONCURRENCY = 8
+
+## Back off and retry analyze_iam_policy calls that hit the quota
+# (RESOURCE_EXHAUSTED) or a transient UNAVAILABLE
+ANALYSIS_RETRY = api_retry.Retry(predicate=api_retry.if_exception_type(
+    ResourceExhausted, ServiceUnavailable),
+                                 initial=1.0,
+                                 maximum=60.0,
+                                 multiplier=2.0,
+                                 deadline=600.0,
+                                 on_error=record_analysis_retry)
+
+
+class ClientProvider:
+    """
+    Hand out a single AssetServiceClient and storage.Client per process.
+    The clients are created lazily on first use and then reused, so the
+    credential discovery and channel setup only happen once, also across
+    warm cloud function invocations. Pre-built clients (or local fakes) can
+    be passed in to replace the real ones
+    """
+
+    def __init__(self, asset_client=None, storage_client=None):
+        self._asset_client = asset_client
+        self._storage_client = storage_client
+        self._lock = threading.Lock()
+
+    def asset_client(self):
+        """Return the shared asset inventory client"""
+        if self._asset_client is None:
+            with self._lock:
+                if self._asset_client is None:
+                    self._asset_client = asset_v1.AssetServiceClient()
+        return self._asset_client
+
+    def storage_client(self):
+        """Return the shared cloud storage client"""
+        if self._storage_client is None:
+            with self._lock:
+                if self._storage_client is None:
+                    self._storage_client = storage.Client()
+        return self._storage_client
+
+
+## Module level so it survives between warm cloud function invocations
+_CLIENT_PROVIDER = ClientProvider()
+
+
+def get_client_provider():
+    """Return the client provider used by all the API calls"""
+    return _CLIENT_PROVIDER
+
+
+def set_client_provider(provider):
+    """
+    Replace the client provider used by all the API calls, returns the
+    previous one so it can be restored
+    """
+    global _CLIENT_PROVIDER
+    previous = _CLIENT_PROVIDER
+    _CLIENT_PROVIDER = provider
+    return previous
+
+
+## Lightweight records holding only the fields the parsing uses, instead of
+# copying every field of the API results with proto.Message.to_dict. The
+# project (projects/<number>) is only kept for the policies of projects
+# themselves, the incremental state uses it to match the project numbers
+# the asset feeds name projects by
+PolicyRecord = namedtuple('PolicyRecord',
+                          ['asset_type', 'resource', 'bindings', 'project'],
+                          defaults=('',))
+BindingRecord = namedtuple('BindingRecord', ['role', 'members'])
+ServiceAccountRecord = namedtuple('ServiceAccountRecord', ['email', 'uid'])
+
+## An entitlement of a principal, via is the group the entitlement is
+# inherited from (empty if it's granted directly)
+EntitlementRecord = namedtuple(
+    'EntitlementRecord', ['role', 'resource_type', 'resource_name', 'via'])
+
+
+def format_entitlement(entitlement):
+    """
+    Format an entitlement the way it's shown in the CSV:
+    role_ResourceType_(resource_name)[_via_group]
+    """
+    role, resource_type, resource_name, via = entitlement
+    if via:
+        return f"{role}_{resource_type}_({resource_name})_via_{via}"
+    return f"{role}_{resource_type}_({resource_name})"
+
+
+def principal_policy_from_json(principal_policy):
+    """
+    Turn the entitlements of a principal policy loaded back from json
+    (where they are lists) into EntitlementRecords again
+    """
+    if principal_policy is not None:
+        principal_policy['Entitlement'] = [
+            EntitlementRecord(*entitlement)
+            for entitlement in principal_policy['Entitlement']
+        ]
+    return principal_policy
+
+
+## Every principal has the same app owner, it's only kept here
+APP_OWNER = "a123456"
+
+
+def sorted_entitlements(entitlements):
+    """
+    Collapse the duplicate entitlements and sort them, so the output
+    doesn't depend on the order the bindings or analysis results came in
+    """
+    return sorted(set(map(EntitlementRecord._make, entitlements)))
+
+
+def render_principal_policy(principal_policy):
+    """
+    Return a copy of a principal policy with its entitlements deduplicated
+    and sorted
+    """
+    return dict(principal_policy,
+                Entitlement=sorted_entitlements(
+                    principal_policy['Entitlement']))
+
+
+## The principals of an EntitlementAccumulator as compact tables that are
+# cheap to send between processes: the fields of the entitlements in one
+# flat list, and a list per principal field, the entitlement ids packed
+# as array bytes (None if the principal is only reserved)
+AccumulatorTable = namedtuple('AccumulatorTable', [
+    'entitlement_fields', 'emails', 'first_names', 'last_names', 'uids',
+    'entitlement_ids'
+])
+
+
+class PrincipalRecord:
+    """
+    The identity of a principal and the ids of its entitlements in the
+    EntitlementAccumulator it belongs to
+    """
+    __slots__ = ('email', 'first_name', 'last_name', 'uid', 'entitlements')
+
+    def __init__(self, email, first_name, last_name, uid, entitlements=None):
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+        self.uid = uid
+        self.entitlements = set() if entitlements is None else entitlements
+
+
+class EntitlementAccumulator:
+    """
+    Collect the entitlements of every principal. Each distinct entitlement
+    (with its role and resource strings interned) is stored once and the
+    principals only keep a set of integer ids, so duplicates collapse and
+    memory per principal stays small. The principals keep the order they
+    were first added in. It reads like a dictionary of email -> principal
+    policy, the principal policies are rendered (with the entitlements
+    sorted) only as they are read. A principal can be reserved with a None
+    placeholder, to be filled in or discarded later
+    """
+
+    def __init__(self):
+        self._entitlement_ids = {}
+        self._entitlements = []
+        self._principals = {}
+
+    def intern(self, entitlement):
+        """
+        Return the id of an entitlement, adding it if it's new
+        """
+        entitlement_id = self._entitlement_ids.get(entitlement)
+        if entitlement_id is None:
+            entitlement_id = len(self._entitlements)
+            entitlement = EntitlementRecord._make(map(sys.intern, entitlement))
+            self._entitlement_ids[entitlement] = entitlement_id
+            self._entitlements.append(entitlement)
+        return entitlement_id
+
+    def _principal(self, email, first_name, last_name, uid):
+        principal = self._principals.get(email)
+        if principal is None:
+            principal = PrincipalRecord(email, first_name, last_name, uid)
+            self._principals[email] = principal
+        return principal
+
+    def add(self, identity, uid, entitlement=None):
+        """
+        Add an identity with an entitlement (or without any)
+        """
+        principal = self._principal(identity.email, identity.first_name,
+                                    identity.last_name, uid)
+        if entitlement is not None:
+            principal.entitlements.add(self.intern(entitlement))
+
+    def add_member(self, identity, uid, entitlement_id):
+        """
+        Add an identity with an entitlement that is interned already, so
+        the members of a binding share one lookup of the entitlement
+        """
+        principal = self._principals.get(identity.email)
+        if principal is None:
+            principal = PrincipalRecord(identity.email, identity.first_name,
+                                        identity.last_name, uid)
+            self._principals[identity.email] = principal
+        principal.entitlements.add(entitlement_id)
+
+    def add_policy(self, principal_policy):
+        """
+        Add a principal policy, like the ones the analysis returns
+        """
+        principal = self._principal(principal_policy['Email'],
+                                    principal_policy['First_Name'],
+                                    principal_policy['Last_Name'],
+                                    principal_policy['UniqueID'])
+        principal.entitlements.update(
+            map(self.intern,
+                map(EntitlementRecord._make, principal_policy['Entitlement'])))
+
+    def reserve(self, email):
+        """
+        Keep a place for a principal that is filled in later, returns False
+        if the principal was already there
+        """
+        if email in self._principals:
+            return False
+        self._principals[email] = None
+        return True
+
+    def discard(self, email):
+        """
+        Remove a principal
+        """
+        self._principals.pop(email, None)
+
+    def merge(self, other):
+        """
+        Add the principals of another accumulator (for example one filled
+        in by a worker process), after the ones already here. The other
+        accumulator is left as it was
+        """
+        for email, principal in other._principals.items():
+            if principal is None:
+                self.reserve(email)
+                continue
+            entitlement_ids = {
+                self.intern(other._entitlements[entitlement_id])
+                for entitlement_id in principal.entitlements
+            }
+            existing = self._principals.get(email)
+            if existing is None:
+                self._principals[email] = PrincipalRecord(
+                    email, principal.first_name, principal.last_name,
+                    principal.uid, entitlement_ids)
+            else:
+                existing.entitlements.update(entitlement_ids)
+
+    def table(self):
+        """
+        Return the accumulator as an AccumulatorTable, which is cheap to
+        send between processes
+        """
+        table = AccumulatorTable([
+            field for entitlement in self._entitlements for field in entitlement
+        ], list(self._principals), [], [], [], [])
+        for principal in self._principals.values():
+            if principal is None:
+                row = (None, None, None, None)
+            else:
+                row = (principal.first_name, principal.last_name, principal.uid,
+                       array('I', principal.entitlements).tobytes())
+            for column, value in zip(table[2:], row):
+                column.append(value)
+        return table
+
+    def merge_table(self, table):
+        """
+        Add the principals of an AccumulatorTable another accumulator
+        returned, after the ones already here. The entitlement ids of the
+        table are mapped to the ids here in bulk
+        """
+        ## Most of the entitlements of a table are new (they name the
+        # resources of its policies), add them in one go
+        fields = iter(table.entitlement_fields)
+        entitlements = list(
+            map(tuple.__new__, repeat(EntitlementRecord),
+                zip(fields, fields, fields, fields)))
+        known_ids = self._entitlement_ids
+        new_entitlements = list(
+            filterfalse(known_ids.__contains__, entitlements))
+        known_ids.update(zip(new_entitlements, count(len(self._entitlements))))
+        self._entitlements.extend(new_entitlements)
+        id_map = list(map(known_ids.__getitem__, entitlements))
+        for email, first_name, last_name, uid, packed_ids in zip(
+                table.emails, table.first_names, table.last_names, table.uids,
+                table.entitlement_ids):
+            if packed_ids is None:
+                self.reserve(email)
+                continue
+            entitlement_ids = array('I')
+            entitlement_ids.frombytes(packed_ids)
+            existing = self._principals.get(email)
+            if existing is None:
+                self._principals[email] = PrincipalRecord(
+                    email, first_name, last_name, uid,
+                    set(map(id_map.__getitem__, entitlement_ids)))
+            else:
+                existing.entitlements.update(
+                    map(id_map.__getitem__, entitlement_ids))
+
+    def render(self, principal):
+        """
+        Return the principal policy of a principal record
+        """
+        return {
+            "First_Name":
+                principal.first_name,
+            "Last_Name":
+                principal.last_name,
+            "UniqueID":
+                principal.uid,
+            "Email":
+                principal.email,
+            "Entitlement":
+                sorted(self._entitlements[entitlement_id]
+                       for entitlement_id in principal.entitlements),
+            "AppOwner":
+                APP_OWNER
+        }
+
+    def entitlement_principals(self):
+        """
+        Return a dictionary of entitlement -> emails of the principals that
+        have it, in the order the principals were added
+        """
+        principals = [[] for _ in self._entitlements]
+        for email, principal in self._principals.items():
+            if principal is not None:
+                for entitlement_id in principal.entitlements:
+                    principals[entitlement_id].append(email)
+        return {
+            entitlement: emails
+            for entitlement, emails in zip(self._entitlements, principals)
+            if emails
+        }
+
+    def __len__(self):
+        return len(self._principals)
+
+    def __contains__(self, email):
+        return email in self._principals
+
+    def get(self, email):
+        """
+        Return the principal policy of a principal, None if it isn't there
+        or only reserved
+        """
+        principal = self._principals.get(email)
+        return None if principal is None else self.render(principal)
+
+    def emails(self):
+        """
+        Return the emails of all the principals, reserved ones included
+        """
+        return list(self._principals)
+
+    def reserved(self):
+        """
+        Return the emails of the principals that are only reserved
+        """
+        return [
+            email for email, principal in self._principals.items()
+            if principal is None
+        ]
+
+    def items(self):
+        """
+        Yield (email, principal policy) for every principal that isn't only
+        reserved
+        """
+        for email, principal in self._principals.items():
+            if principal is not None:
+                yield email, self.render(principal)
+
+    def values(self):
+        """
+        Yield the principal policy of every principal that isn't only
+        reserved
+        """
+        for _, principal_policy in self.items():
+            yield principal_policy
+
+
+def policy_record_from_proto(search_result):
+    """
+    Create a PolicyRecord from an IamPolicySearchResult message, reading the
+    fields straight from the underlying protobuf
+    """
+    result_pb = asset_v1.IamPolicySearchResult.pb(search_result)
+    bindings = tuple(
+        BindingRecord(binding.role, tuple(binding.members))
+        for binding in result_pb.policy.bindings)
+    project = (result_pb.project
+               if result_pb.asset_type == PROJECT_ASSET_TYPE else '')
+    return PolicyRecord(result_pb.asset_type, result_pb.resource, bindings,
+                        project)
+
+
+def policy_record_from_dict(iam_policy):
+    """
+    Create a PolicyRecord from a dictionary, gcloud uses camelCase keys
+    and the client libraries use under_scores so both are supported
+    """
+    if 'asset_type' in iam_policy:
+        asset_type = iam_policy['asset_type']
+    else:
+        asset_type = iam_policy['assetType']
+    policy = iam_policy.get('policy') or {}
+    bindings = tuple(
+        BindingRecord(binding['role'], tuple(binding.get('members', ())))
+        for binding in policy.get('bindings') or ())
+    project = (iam_policy.get('project', '')
+               if asset_type == PROJECT_ASSET_TYPE else '')
+    return PolicyRecord(asset_type, iam_policy['resource'], bindings, project)
+
+
+def sa_record_from_proto(search_result):
+    """
+    Create a ServiceAccountRecord from a ResourceSearchResult message,
+    reading the fields straight from the underlying protobuf
+    """
+    result_pb = asset_v1.ResourceSearchResult.pb(search_result)
+    attributes = result_pb.additional_attributes.fields
+    return ServiceAccountRecord(attributes['email'].string_value,
+                                attributes['uniqueId'].string_value)
+
+
+def sa_record_from_dict(svc_account):
+    """
+    Create a ServiceAccountRecord from a dictionary, returns None if the
+    dictionary doesn't have the service account attributes
+    """
+    ## Looks like gcloud assets --format json and
+    # python client libraries uses different
+    # formatting for keys, gcloud uses camelCase
+    # and api use under_scores, manually checking
+    # for both to support both use cases
+    if 'additional_attributes' in svc_account:
+        attributes = svc_account['additional_attributes']
+    elif 'additionalAttributes' in svc_account:
+        attributes = svc_account['additionalAttributes']
+    else:
+        return None
+    return ServiceAccountRecord(attributes['email'], attributes['uniqueId'])
+
+
+## Which policies, members and service accounts are fetched and reported
+# on. Empty include lists mean everything, the names are excluded from the
+# service account search
+AssetFilters = namedtuple('AssetFilters', [
+    'include_asset_types', 'exclude_asset_types', 'member_types',
+    'exclude_names'
+])
+
+DEFAULT_ASSET_FILTERS = AssetFilters(
+    include_asset_types=(),
+    exclude_asset_types=('orgpolicy.googleapis.com/Policy',),
+    member_types=(),
+    exclude_names=('sandbox', 'nonprod'))
+
+## The largest page the search APIs hand out, fewer pages means fewer
+# round trips
+SEARCH_PAGE_SIZE = 500
+
+## Only the fields of the service accounts that are used
+SA_READ_MASK = ('name', 'additional_attributes')
+
+
+def asset_filters_from_strings(include_asset_types=None,
+                               exclude_asset_types=None,
+                               member_types=None,
+                               exclude_names=None):
+    """
+    Create the asset filters from comma separated lists, the ones that are
+    None keep their default
+    """
+
+    def split(value, default):
+        if value is None:
+            return default
+        return tuple(item.strip() for item in value.split(',') if item.strip())
+
+    return AssetFilters(
+        split(include_asset_types, DEFAULT_ASSET_FILTERS.include_asset_types),
+        split(exclude_asset_types, DEFAULT_ASSET_FILTERS.exclude_asset_types),
+        split(member_types, DEFAULT_ASSET_FILTERS.member_types),
+        split(exclude_names, DEFAULT_ASSET_FILTERS.exclude_names))
+
+
+def iam_policy_search_request(scope, asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Build the search_all_iam_policies request, the included asset types and
+    the member types are pushed down to the API. Excluded asset types can't
+    be expressed in the request, they are dropped by filter_iam_policy
+    """
+    request = {"scope": scope, "page_size": SEARCH_PAGE_SIZE}
+    if asset_filters.include_asset_types:
+        request["asset_types"] = list(asset_filters.include_asset_types)
+    if asset_filters.member_types:
+        request["query"] = " OR ".join(
+            f"memberTypes:{member_type}"
+            for member_type in asset_filters.member_types)
+    return request
+
+
+def sa_search_request(scope, asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Build the search_all_resources request for the service accounts, only
+    the name and the additional attributes (email and uniqueId) are read
+    """
+    request = {
+        "scope": scope,
+        "asset_types": ['iam.googleapis.com/ServiceAccount'],
+        "page_size": SEARCH_PAGE_SIZE,
+        "read_mask": field_mask_pb2.FieldMask(paths=list(SA_READ_MASK))
+    }
+    if asset_filters.exclude_names:
+        request["query"] = (
+            f"NOT name:({' OR '.join(asset_filters.exclude_names)})")
+    return request
+
+
+def filter_iam_policy(iam_policy, asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Apply the filters that can't be pushed down to the API (or that have
+    to be applied to the local exports) to a PolicyRecord. The members of
+    the other types and the bindings left without members are dropped.
+    Returns None if nothing is left of the policy
+    """
+    if iam_policy.asset_type in asset_filters.exclude_asset_types:
+        return None
+    if (asset_filters.include_asset_types and
+            iam_policy.asset_type not in asset_filters.include_asset_types):
+        return None
+    bindings = iam_policy.bindings
+    if asset_filters.member_types:
+        bindings = (BindingRecord(
+            binding.role,
+            tuple(member
+                  for member in binding.members
+                  if member.split(':')[0] in asset_filters.member_types))
+                    for binding in bindings)
+    bindings = tuple(binding for binding in bindings if binding.members)
+    if not bindings:
+        return None
+    ## Compare the bindings themselves, members can be dropped without
+    # dropping a whole binding
+    if bindings != iam_policy.bindings:
+        return iam_policy._replace(bindings=bindings)
+    return iam_policy
+
+
+def filter_iam_policies(all_iam_policies, asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Filter a stream of PolicyRecords with filter_iam_policy
+    """
+    for iam_policy in all_iam_policies:
+        iam_policy = filter_iam_policy(iam_policy, asset_filters)
+        if iam_policy is not None:
+            yield iam_policy
+
+
+## How the inventory is collected: a single search over the whole org, or
+# concurrent searches over its top level folders or over its projects
+SCOPE_MODES = ('org', 'folders', 'projects')
+
+## Default number of scope searches run at once
+SCOPE_CONCURRENCY = 8
+
+PROJECT_ASSET_TYPE = 'cloudresourcemanager.googleapis.com/Project'
+FOLDER_ASSET_TYPE = 'cloudresourcemanager.googleapis.com/Folder'
+RESOURCE_MANAGER_PREFIX = '//cloudresourcemanager.googleapis.com/'
+
+## Policies that can live outside of any folder or project, they are
+# searched at the org scope when the inventory is collected per folder or
+# per project
+ORG_LEVEL_ASSET_TYPES = ('cloudresourcemanager.googleapis.com/Organization',
+                         FOLDER_ASSET_TYPE,
+                         'cloudresourcemanager.googleapis.com/TagKey',
+                         'cloudresourcemanager.googleapis.com/TagValue')
+
+## Errors that fail the search of a scope
+SEARCH_ERRORS = (GoogleAPIError, googleapiclient.errors.HttpError)
+
+## A scope to search in, limited to some asset types (empty means all)
+SearchScope = namedtuple('SearchScope', ['scope', 'asset_types'])
+
+
+class SearchScopes:
+    """
+    The scopes the inventory of an org is searched in and how many of the
+    searches run at once. The scopes are listed on first use, so a run
+    that doesn't search (a feed update) doesn't list them. The searches
+    that failed are collected in failed_scopes as (scope, method) tuples
+    instead of ending the run, so the rest of the inventory is still
+    reported on
+    """
+
+    def __init__(self, org_id, scope_mode='org', max_workers=SCOPE_CONCURRENCY):
+        self.org_id = org_id
+        self.scope_mode = scope_mode
+        self.max_workers = max_workers
+        self.failed_scopes = []
+        self._scopes = None
+
+    def get_scopes(self):
+        """
+        Return the SearchScopes to search in, they are listed only once
+        """
+        if self._scopes is None:
+            self._scopes = list_search_scopes(self.org_id, self.scope_mode)
+        return self._scopes
+
+    def add_failure(self, scope, method, err):
+        """
+        Record a search that failed in a scope
+        """
+        print(f'API Error: {method} failed in {scope}, '
+              f'continuing without it: {err}')
+        get_run_metrics().record_error(method)
+        self.failed_scopes.append((scope, method))
+
+    def summary(self):
+        """
+        Return a line telling how many searches failed, or None if none did
+        """
+        if not self.failed_scopes:
+            return None
+        scopes = ', '.join(
+            f"{scope} ({method})" for scope, method in self.failed_scopes)
+        return (f"{len(self.failed_scopes)} searches failed, the results are "
+                f"incomplete: {scopes}")
+
+
+def search_retry(method):
+    """
+    Back off and retry a search that hits the quota (RESOURCE_EXHAUSTED) or
+    a transient UNAVAILABLE, concurrent scope searches share the quota
+    """
+    return api_retry.Retry(
+        predicate=api_retry.if_exception_type(ResourceExhausted,
+                                              ServiceUnavailable),
+        initial=1.0,
+        maximum=60.0,
+        multiplier=2.0,
+        deadline=600.0,
+        on_error=lambda err: get_run_metrics().record_retry(method))
+
+
+def list_search_scopes(org_id, scope_mode='org'):
+    """
+    Return the SearchScope records the inventory of the org is collected
+    from. In folders mode those are the top level folders and the projects right
+    under the org, in projects mode every active project. The policies
+    outside of them are searched at the org scope. If the folders and
+    projects can't be listed the whole org is searched at once
+    """
+    org_scope = f"organizations/{org_id}"
+    if scope_mode == 'org':
+        return [SearchScope(org_scope, ())]
+    org_name = f"{RESOURCE_MANAGER_PREFIX}{org_scope}"
+    asset_types = [PROJECT_ASSET_TYPE]
+    if scope_mode == 'folders':
+        asset_types.append(FOLDER_ASSET_TYPE)
+    request = {
+        "scope":
+            org_scope,
+        "asset_types":
+            asset_types,
+        "page_size":
+            SEARCH_PAGE_SIZE,
+        "read_mask":
+            field_mask_pb2.FieldMask(paths=[
+                'name', 'asset_type', 'project', 'parent_full_resource_name',
+                'state'
+            ])
+    }
+    client = get_client_provider().asset_client()
+    scopes = []
+    try:
+        with get_run_metrics().stage('list_scopes'):
+            for result in iter_search(client, 'search_all_resources', request,
+                                      lambda result: result, org_id):
+                ## Projects pending deletion can't be searched anymore
+                if result.state and result.state != 'ACTIVE':
+                    continue
+                if result.asset_type == FOLDER_ASSET_TYPE:
+                    if result.parent_full_resource_name == org_name:
+                        scopes.append(
+                            SearchScope(
+                                result.name[len(RESOURCE_MANAGER_PREFIX):], ()))
+                elif (scope_mode == 'projects' or
+                      result.parent_full_resource_name == org_name):
+                    scopes.append(SearchScope(result.project, ()))
+    except SEARCH_ERRORS as err:
+        print(f'API Error listing the {scope_mode} of {org_scope}, '
+              f'searching the whole org instead: {err}')
+        return [SearchScope(org_scope, ())]
+    scopes.append(SearchScope(org_scope, ORG_LEVEL_ASSET_TYPES))
+    print(f"Searching the inventory in {len(scopes)} scopes")
+    return scopes
+
+
+def scoped_request(request, search_scope):
+    """
+    Narrow a search request down to the asset types of the scope, returns
+    None if none of the requested asset types are searched in the scope
+    """
+    if not search_scope.asset_types:
+        return request
+    asset_types = [
+        asset_type
+        for asset_type in request.get("asset_types") or search_scope.asset_types
+        if asset_type in search_scope.asset_types
+    ]
+    if not asset_types:
+        return None
+    return dict(request, asset_types=asset_types)
+
+
+def iter_search(client, method, request, convert, org_id=None):
+    """
+    Run a search and yield its results converted by convert one at a time
+    (the Nones are dropped), the result pages are only fetched as they are
+    consumed. The calls are held to the API quota of the org
+    """
+    throttle_api_call(method, org_id)
+    start = time.perf_counter()
+    response = getattr(client, method)(request=request,
+                                       retry=search_retry(method))
+    for result in iter_search_results(response, method,
+                                      time.perf_counter() - start, org_id):
+        record = convert(result)
+        if record is not None:
+            yield record
+
+
+def policy_record_to_list(iam_policy):
+    """
+    Turn a PolicyRecord into a compact json list
+    """
+    return [
+        iam_policy.asset_type, iam_policy.resource,
+        [[binding.role, binding.members] for binding in iam_policy.bindings],
+        iam_policy.project
+    ]
+
+
+def policy_record_from_list(record):
+    """
+    Create a PolicyRecord from the list policy_record_to_list made
+    """
+    asset_type, resource, bindings, project = record
+    return PolicyRecord(
+        asset_type, resource,
+        tuple(
+            BindingRecord(role, tuple(members)) for role, members in bindings),
+        project)
+
+
+## How the records of the searches are kept in the run checkpoint
+CHECKPOINT_CODECS = {
+    'search_all_iam_policies': (policy_record_to_list, policy_record_from_list),
+    'search_all_resources': (list, ServiceAccountRecord._make)
+}
+
+
+def iter_checkpointed_search(client, method, request, convert, org_id=None):
+    """
+    iter_search that keeps the fetched pages in the run checkpoint, if
+    there is one. The records saved by an earlier run are handed out first
+    and the search goes on from the page after them. If the search fails
+    while resuming (page tokens expire) its saved pages are dropped, so the
+    next run starts it over
+    """
+    checkpoint = get_run_checkpoint()
+    if checkpoint is None:
+        yield from iter_search(client, method, request, convert, org_id)
+        return
+    encode, decode = CHECKPOINT_CODECS[method]
+    key = f"{method} {request['scope']}"
+    records, page_token, done = checkpoint.get_search(key)
+    yield from map(decode, records)
+    if done:
+        return
+    if page_token:
+        request = dict(request, page_token=page_token)
+    try:
+        throttle_api_call(method, org_id)
+        start = time.perf_counter()
+        response = getattr(client, method)(request=request,
+                                           retry=search_retry(method))
+        for page in iter_search_pages(response, method,
+                                      time.perf_counter() - start, org_id):
+            records = [
+                record for record in map(convert, page.results)
+                if record is not None
+            ]
+            checkpoint.add_page(key, [encode(record) for record in records],
+                                page.next_page_token)
+            yield from records
+    except SEARCH_ERRORS:
+        if page_token:
+            checkpoint.reset_search(key)
+        raise
+    checkpoint.add_page(key, [], None)
+
+
+def iter_scoped_search(search_scopes, method, build_request, convert, key):
+    """
+    Run a search in every scope and yield the converted results, the ones
+    found in more than one scope (by key) only once. A single scope is
+    searched lazily, more of them are searched concurrently and handed out
+    in scope order. A scope whose search fails is skipped, the run only
+    stops if the search failed in every scope
+    """
+    client = get_client_provider().asset_client()
+    requests = []
+    for search_scope in search_scopes.get_scopes():
+        request = scoped_request(build_request(search_scope.scope),
+                                 search_scope)
+        if request is not None:
+            requests.append((search_scope.scope, request))
+    failed = 0
+    if len(requests) == 1:
+        scope, request = requests[0]
+        try:
+            yield from iter_checkpointed_search(client, method, request,
+                                                convert, search_scopes.org_id)
+        except SEARCH_ERRORS as err:
+            failed += 1
+            search_scopes.add_failure(scope, method, err)
+    elif requests:
+        seen = set()
+        in_flight = deque()
+        pending = iter(requests)
+        with ThreadPoolExecutor(
+                max_workers=search_scopes.max_workers) as executor:
+            try:
+                ## Keep a bounded window of searches going, so the scopes
+                # that finish early don't pile up behind a slow one
+                while True:
+                    for scope, request in islice(
+                            pending,
+                            2 * search_scopes.max_workers - len(in_flight)):
+                        in_flight.append(
+                            (scope,
+                             executor.submit(
+                                 list,
+                                 iter_checkpointed_search(
+                                     client, method, request, convert,
+                                     search_scopes.org_id))))
+                    if not in_flight:
+                        break
+                    scope, future = in_flight.popleft()
+                    try:
+                        records = future.result()
+                    except SEARCH_ERRORS as err:
+                        failed += 1
+                        search_scopes.add_failure(scope, method, err)
+                        continue
+                    for record in records:
+                        record_key = key(record)
+                        if record_key not in seen:
+                            seen.add(record_key)
+                            yield record
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+    if requests and failed == len(requests):
+        print(f'API Error: {method} failed in every scope')
         exit(0)
-        # raise RuntimeError(f'Error fetching Asset Inventory entries: {e}')
-    # all_sas = {}
-    # for resource in response:
-    #     # print(resource.name.split('/')[-1])
-    #     gcp_sas_list.append(resource.name.split('/')[-1])
-    ## converting protobuf to dictionary
-    # https://github.com/googleapis/python-vision/issues/70#issuecomment-749135327
-    serializable_assets = [proto.Message.to_dict(asset) for asset in response]
-    # proto_contents = json.loads(serializable_assets)
-    return serializable_assets
+
+
+def iter_all_sas(org_id,
+                 asset_filters=DEFAULT_ASSET_FILTERS,
+                 search_scopes=None):
+    """
+    Get all the Service Accounts and yield them one at a time as
+    ServiceAccountRecords, the result pages are only fetched as they are
+    consumed. Without search scopes the whole org is searched at once
+    """
+    if search_scopes is None:
+        search_scopes = SearchScopes(org_id)
+    yield from iter_scoped_search(
+        search_scopes, 'search_all_resources',
+        lambda scope: sa_search_request(scope, asset_filters),
+        sa_record_from_proto, lambda sa_record: sa_record.email)
+
+
+def get_all_sas(org_id,
+                asset_filters=DEFAULT_ASSET_FILTERS,
+                search_scopes=None):
+    """
+    Get a list of Service Account and return them as a list of
+    ServiceAccountRecords
+    """
+    return list(iter_all_sas(org_id, asset_filters, search_scopes))
 
 
 def get_iam_policies(svc_account, org_id):
@@ -53,7 +1307,7 @@ def get_iam_policies(svc_account, org_id):
     """
     scope = f"organizations/{org_id}"
     query = f"policy:{svc_account}"
-    client = asset_v1.AssetServiceClient()
+    client = get_client_provider().asset_client()
     try:
         response = client.search_all_iam_policies(request={
             "scope": scope,
@@ -72,326 +1326,1935 @@ def get_iam_policies(svc_account, org_id):
         # print(sa_permissions)
         # print(policy)
 
-    return sa_permissions
+    return sa_permissions
+
+
+def iter_all_iam_policies(org_id,
+                          asset_filters=DEFAULT_ASSET_FILTERS,
+                          search_scopes=None):
+    """
+    Get all the IAM policies in the organization and yield them one at a
+    time as filtered PolicyRecords, the result pages are only fetched as
+    they are consumed. Without search scopes the whole org is searched at
+    once
+    """
+
+    def policy_record(search_result):
+        return filter_iam_policy(policy_record_from_proto(search_result),
+                                 asset_filters)
+
+    if search_scopes is None:
+        search_scopes = SearchScopes(org_id)
+    yield from iter_scoped_search(
+        search_scopes, 'search_all_iam_policies',
+        lambda scope: iam_policy_search_request(scope, asset_filters),
+        policy_record, lambda iam_policy: iam_policy.resource)
+
+
+def get_all_iam_policies(org_id,
+                         asset_filters=DEFAULT_ASSET_FILTERS,
+                         search_scopes=None):
+    """
+    Get all the IAM policies in the organization and return them as a list
+    of PolicyRecords
+    """
+    return list(iter_all_iam_policies(org_id, asset_filters, search_scopes))
+
+
+def upload_content_gcp_bucket(gcp_bucket, dest_filename, file_contents):
+    """Uploads a file to the bucket by using it's contents"""
+    storage_client = get_client_provider().storage_client()
+    bucket = storage_client.bucket(gcp_bucket)
+    blob = bucket.blob(dest_filename)
+
+    blob.upload_from_string(file_contents)
+
+
+def upload_file_gcp_bucket(gcp_bucket, dest_filename, source_file):
+    """Uploads a file to the bucket."""
+    storage_client = get_client_provider().storage_client()
+    bucket = storage_client.bucket(gcp_bucket)
+    blob = bucket.blob(dest_filename)
+
+    blob.upload_from_filename(source_file)
+
+
+def split_gcs_uri(gcs_uri):
+    """Split a gs://bucket/object uri into the bucket and object names"""
+    gcp_bucket, _, object_name = gcs_uri[len('gs://'):].partition('/')
+    return gcp_bucket, object_name
+
+
+def read_bytes_from_location(location):
+    """
+    Read the contents of a local file or a gs://bucket/object uri, returns
+    None if it doesn't exist yet
+    """
+    if location.startswith('gs://'):
+        gcp_bucket, object_name = split_gcs_uri(location)
+        storage_client = get_client_provider().storage_client()
+        blob = storage_client.bucket(gcp_bucket).blob(object_name)
+        try:
+            return blob.download_as_bytes()
+        except NotFound:
+            return None
+    if not os.path.exists(location):
+        return None
+    with open(location, 'rb') as file_handler:
+        return file_handler.read()
+
+
+def write_bytes_to_location(location, contents):
+    """Write contents to a local file or a gs://bucket/object uri"""
+    if location.startswith('gs://'):
+        gcp_bucket, object_name = split_gcs_uri(location)
+        upload_content_gcp_bucket(gcp_bucket, object_name, contents)
+    else:
+        with open(location, 'wb') as file_handler:
+            file_handler.write(contents)
+
+
+def delete_location(location):
+    """Delete a local file or a gs://bucket/object uri, if it exists"""
+    if location.startswith('gs://'):
+        gcp_bucket, object_name = split_gcs_uri(location)
+        storage_client = get_client_provider().storage_client()
+        try:
+            storage_client.bucket(gcp_bucket).blob(object_name).delete()
+        except NotFound:
+            pass
+    elif os.path.exists(location):
+        os.remove(location)
+
+
+## Amount of text read from the json exports at a time
+JSON_READ_SIZE = 1024 * 1024
+
+
+def detect_json_encoding(head):
+    """
+    Work out the encoding of a json file from the BOM in its first bytes
+    or, without one, from where the null bytes are in the first characters
+    (json always starts with an ascii character)
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        ## The utf-16 codec reads the BOM to pick the byte order
+        return 'utf-16'
+    if len(head) >= 2 and head[0] != 0 and head[1] == 0:
+        return 'utf-16-le'
+    if len(head) >= 2 and head[0] == 0 and head[1] != 0:
+        return 'utf-16-be'
+    return 'utf-8'
+
+
+class JsonTextReader:
+    """
+    Decode the text of a json file (a binary file object) as it's needed
+    and hand out the json values in it one at a time. Only the text of the
+    value being decoded is kept in memory
+    """
+
+    def __init__(self, json_file):
+        head = json_file.read(4)
+        self._file = json_file
+        self._text_decoder = codecs.getincrementaldecoder(
+            detect_json_encoding(head))()
+        self._decoder = json.JSONDecoder()
+        self.buffer = self._text_decoder.decode(head)
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self, size):
+        """
+        Drop the text that is used up and add at least size more bytes of
+        the file to the buffer, returns False at the end of the file
+        """
+        parts = []
+        while size > 0:
+            data = self._file.read(max(size, JSON_READ_SIZE))
+            ## A read can end in the middle of a character
+            parts.append(self._text_decoder.decode(data, final=not data))
+            if not data:
+                self.eof = True
+                break
+            size -= len(data)
+        self.buffer = self.buffer[self.pos:] + ''.join(parts)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self, separators=''):
+        """
+        Skip the whitespace and the separators and return the next
+        character, an empty string at the end of the file
+        """
+        while True:
+            while self.pos < len(
+                    self.buffer) and (self.buffer[self.pos].isspace() or
+                                      self.buffer[self.pos] in separators):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof or not self._read_more(JSON_READ_SIZE):
+                if self.pos == len(self.buffer):
+                    return ''
+
+    def expect(self, char):
+        """
+        Skip the whitespace and the given character, which has to be next
+        """
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer,
+                                       self.pos)
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode the json value at the current position. A value that runs
+        past the text read so far is retried with the buffer doubled, so
+        a large value is decoded a few times at most instead of once per
+        read
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._read_more(len(self.buffer) - self.pos)
+                continue
+            ## A number can go on in the text that isn't read yet
+            if end == len(self.buffer) and not self.eof:
+                self._read_more(JSON_READ_SIZE)
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_records(json_file, in_array=None, iter_record=None):
+    """
+    Given a json file (a filename or a binary file object, like a bucket
+    object opened with blob.open('rb')) yield the records in it one at a
+    time. The file can either be a top level json array, like the output
+    of `gcloud asset ... --format json`, or json lines (one record per
+    line). The file is decoded and parsed incrementally so only the records
+    that are being parsed are kept in memory. in_array is worked out from
+    the first character, a slice of the records inside an array is read
+    with in_array=True. If iter_record is passed it's called with the
+    JsonTextReader at the start of every record and yields what the record
+    is turned into, so a huge record can be walked instead of decoded whole
+    """
+    if isinstance(json_file, (str, os.PathLike)):
+        with open(json_file, 'rb') as json_file_handler:
+            yield from iter_json_records(json_file_handler, in_array,
+                                         iter_record)
+        return
+
+    try:
+        reader = JsonTextReader(json_file)
+        if in_array is None:
+            in_array = reader.peek() == '['
+            if in_array:
+                reader.pos += 1
+        while True:
+            char = reader.peek(',' if in_array else '')
+            if not char or (in_array and char == ']'):
+                return
+            if iter_record is None:
+                yield reader.value()
+            else:
+                yield from iter_record(reader)
+    except UnicodeDecodeError:
+        print("Unable to determine file encoding, it's not utf-8 or utf-16")
+        exit(0)
+
+
+def json_text_codec(head):
+    """
+    The codec of a json file without its BOM, to search the raw bytes
+    """
+    encoding = detect_json_encoding(head)
+    if encoding == 'utf-8-sig':
+        return 'utf-8'
+    if encoding == 'utf-16':
+        return ('utf-16-le'
+                if head.startswith(codecs.BOM_UTF16_LE) else 'utf-16-be')
+    return encoding
+
+
+def split_json_records(filename, range_size):
+    """
+    Split a json file into byte ranges of about range_size that each hold
+    whole records, so they can be decoded separately. The records have to
+    start on lines of their own with the same indentation, which is how
+    gcloud (and json lines) lay them out: nested values are indented
+    further and a json string can't hold a raw newline, so a newline
+    followed by that indentation and a { always starts a record. Returns
+    a tuple of (ranges, in_array), or None if the records aren't laid out
+    that way
+    """
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as json_file_handler:
+        head = json_file_handler.read(JSON_READ_SIZE)
+        codec = json_text_codec(head)
+        width = len(' '.encode(codec))
+        text = head.decode(codec, errors='ignore').lstrip('\ufeff')
+        first = text.lstrip()
+        in_array = first.startswith('[')
+        if in_array:
+            first = first[1:].lstrip()
+        if not first.startswith('{'):
+            return None
+        record_start = len(text) - len(first)
+        line_start = text.rfind('\n', 0, record_start) + 1
+        indent = text[line_start:record_start]
+        if indent.strip():
+            return None
+        bom_size = 0
+        if head.startswith(codecs.BOM_UTF8):
+            bom_size = len(codecs.BOM_UTF8)
+        elif head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            bom_size = width
+        marker = ('\n' + indent + '{').encode(codec)
+
+        ## Every range starts at the newline before a record (the first
+        # one of json lines can start at the top of the file)
+        start = bom_size
+        if line_start:
+            start += len(text[:line_start - 1].encode(codec))
+        ranges = []
+        while True:
+            boundary = None
+            offset = start + range_size
+            while offset < file_size:
+                json_file_handler.seek(offset)
+                window = json_file_handler.read(JSON_READ_SIZE + len(marker))
+                found = window.find(marker)
+                ## utf-16 characters start on even offsets
+                while found != -1 and (offset + found - bom_size) % width:
+                    found = window.find(marker, found + 1)
+                if found != -1:
+                    boundary = offset + found
+                    break
+                offset += JSON_READ_SIZE
+            if boundary is None:
+                ranges.append((start, file_size))
+                return ranges, in_array
+            ranges.append((start, boundary))
+            start = boundary
+
+
+def import_json_as_dictionary(filename):
+    """
+    Given a json file import it and return the contents as a dictionary
+    """
+    return list(iter_json_records(filename))
+
+
+def build_sa_index(all_sas_dictionary):
+    """
+    Build a lookup table of service account email -> uniqueId so the
+    policy parsing can resolve each member in constant time instead of
+    walking the whole service account list for every binding
+    """
+    sa_index = {}
+    for svc_account in all_sas_dictionary:
+        ## Keep the first match to behave like the old linear scan
+        sa_index.setdefault(svc_account.email, svc_account.uid)
+
+    return sa_index
+
+
+def get_uid_from_email(sa_email, sa_index):
+    '''
+    Given an email address and the service account index get the uid
+    from the email attribute
+    '''
+    ## If the email is not in the index it's not customer owned but a
+    ## gcp owned agent service account, so marking it as such
+    return sa_index.get(sa_email, "gcp_owned")
+
+
+## Defaults for the analyze_iam_policy results cache
+ANALYSIS_CACHE_TTL = 24 * 60 * 60
+ANALYSIS_CACHE_MAX_ENTRIES = 100000
+
+
+class AnalysisCache:
+    """
+    Persistent cache of the iam-policy-analyze results keyed by org and
+    principal, backed by a SQLite database. The database can be a local
+    file or a gs://bucket/object uri, in which case it's downloaded when the
+    cache is opened and uploaded again when it's closed. Entries expire
+    after `ttl` seconds and the least recently used ones are evicted once
+    there are more than `max_entries`
+    """
+
+    ## Evict and commit after this many new entries
+    FLUSH_EVERY = 1000
+
+    def __init__(self,
+                 location,
+                 ttl=ANALYSIS_CACHE_TTL,
+                 max_entries=ANALYSIS_CACHE_MAX_ENTRIES):
+        self.location = location
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        if location.startswith('gs://'):
+            db_fd, self._db_path = tempfile.mkstemp(suffix='.sqlite3')
+            with os.fdopen(db_fd, 'wb') as db_file:
+                db_file.write(read_bytes_from_location(location) or b'')
+        else:
+            self._db_path = location
+        self._conn = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS analysis_cache ("
+                           "org_id TEXT NOT NULL, "
+                           "principal TEXT NOT NULL, "
+                           "result TEXT, "
+                           "created REAL NOT NULL, "
+                           "last_access REAL NOT NULL, "
+                           "PRIMARY KEY (org_id, principal))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analysis_cache_lru "
+                           "ON analysis_cache (last_access)")
+        self._conn.commit()
+
+    def get(self, org_id, principal):
+        """
+        Look up the cached analysis of a principal, returns a tuple of
+        (found, principal policy)
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, created FROM analysis_cache "
+                "WHERE org_id = ? AND principal = ?",
+                (org_id, principal)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return False, None
+            self._conn.execute(
+                "UPDATE analysis_cache SET last_access = ? "
+                "WHERE org_id = ? AND principal = ?", (now, org_id, principal))
+            self.hits += 1
+        return True, principal_policy_from_json(json.loads(row[0]))
+
+    def put(self, org_id, principal, principal_policy):
+        """Cache the analysis of a principal"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache "
+                "(org_id, principal, result, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (org_id, principal, json.dumps(principal_policy), now, now))
+            self._pending += 1
+            if self._pending >= self.FLUSH_EVERY:
+                self._flush()
+
+    def invalidate(self, principals=None, org_id=None):
+        """
+        Drop cached entries, for example after a group membership change.
+        Without arguments the whole cache is dropped
+        """
+        query = "DELETE FROM analysis_cache WHERE 1 = 1"
+        params = []
+        if org_id is not None:
+            query += " AND org_id = ?"
+            params.append(org_id)
+        with self._lock:
+            if principals is None:
+                removed = self._conn.execute(query, params).rowcount
+            else:
+                removed = 0
+                for principal in principals:
+                    removed += self._conn.execute(query + " AND principal = ?",
+                                                  params + [principal]).rowcount
+            self._conn.commit()
+        return removed
+
+    def _flush(self):
+        """Remove the expired and least recently used entries and commit"""
+        self._conn.execute("DELETE FROM analysis_cache WHERE created < ?",
+                           (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM analysis_cache WHERE rowid IN ("
+            "SELECT rowid FROM analysis_cache ORDER BY last_access DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._conn.commit()
+        self._pending = 0
+
+    def summary(self):
+        """Return a line with the hit and miss rates of this run"""
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"Analysis cache: {self.hits} hits, {self.misses} misses "
+                f"({hit_rate:.1f}% hit rate)")
+
+    def close(self):
+        """Save the cache, uploading it back to GCS if needed"""
+        with self._lock:
+            self._flush()
+            self._conn.close()
+        if self.location.startswith('gs://'):
+            with open(self._db_path, 'rb') as db_file:
+                write_bytes_to_location(self.location, db_file.read())
+            os.remove(self._db_path)
+
+
+## Only set while a run with the analysis cache turned on is going
+_ANALYSIS_CACHE = None
+
+
+def get_analysis_cache():
+    """Return the analysis cache in use, None if caching is turned off"""
+    return _ANALYSIS_CACHE
+
+
+def set_analysis_cache(cache):
+    """
+    Set the analysis cache used by get_policy_for_identity, returns the
+    previous one so it can be restored
+    """
+    global _ANALYSIS_CACHE
+    previous = _ANALYSIS_CACHE
+    _ANALYSIS_CACHE = cache
+    return previous
+
+
+## Seconds between two saves of the run checkpoint
+CHECKPOINT_INTERVAL = 60
+
+## Bumped whenever the layout of the checkpoint changes
+CHECKPOINT_VERSION = 3
+
+
+class CheckpointTimeLimit(Exception):
+    """
+    Raised when a checkpointed run reaches its time limit, the progress is
+    saved and the next run picks up from there
+    """
+
+
+class RunCheckpoint:
+    """
+    The progress of a remote run: the records of the search pages fetched
+    so far with the token of the next page, per search and scope, and the
+    principals that are analyzed already. It's saved to a local path or a
+    gs:// uri at most every interval seconds (and when the run fails) and
+    a run with the same settings resumes from it. Every save writes the
+    pages and principals added since the previous save once, as a new
+    segment object next to the checkpoint (<location>.<n>), then rewrites
+    the checkpoint itself, which only lists the segments and the page
+    tokens. So a save doesn't get slower as the inventory grows and only
+    the progress that isn't saved yet is kept in memory. A finished org
+    wide analysis export is recorded too, so a resumed run reuses it
+    instead of exporting again. Past the time
+    limit (if any) the run is stopped with CheckpointTimeLimit. The methods
+    are thread safe
+    """
+
+    def __init__(self,
+                 location,
+                 fingerprint,
+                 interval=CHECKPOINT_INTERVAL,
+                 time_limit=None):
+        self.location = location
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.deadline = (time.monotonic() + time_limit if time_limit else None)
+        ## search key -> page token, done and the first segment holding
+        # its records (the earlier ones are from before it was reset)
+        self.searches = {}
+        ## The principals analyzed by the earlier runs
+        self.principals = {}
+        ## Where an earlier run exported the org wide analysis to
+        self.org_export = None
+        self._resumed_records = {}
+        self._new_records = {}
+        self._new_principals = {}
+        self._segments = []
+        self._next_segment = 0
+        self._stale_segments = []
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def segment_location(self, index):
+        """
+        Where the segment with the given index is kept
+        """
+        return f"{self.location}.{index}"
+
+    def load(self):
+        """
+        Load the saved progress, unless it was saved by a run with other
+        settings or by a different version of the script. Returns True if
+        there was progress to resume from
+        """
+        contents = read_bytes_from_location(self.location)
+        if contents is None:
+            return False
+        saved = json.loads(gzip.decompress(contents))
+        if (saved.get('version') != CHECKPOINT_VERSION or
+                saved.get('fingerprint') != self.fingerprint):
+            print(f"Ignoring the checkpoint at {self.location}, it was "
+                  "saved by a run with different settings")
+            self._stale_segments = saved.get('segments', [])
+            return False
+        searches = saved['searches']
+        resumed_records = {}
+        principals = {}
+        for index in saved['segments']:
+            contents = read_bytes_from_location(self.segment_location(index))
+            if contents is None:
+                print(f"Ignoring the checkpoint at {self.location}, its "
+                      f"segment {self.segment_location(index)} is missing")
+                self._stale_segments = saved['segments']
+                return False
+            segment = json.loads(gzip.decompress(contents))
+            for key, records in segment['records'].items():
+                if key in searches and index >= searches[key]['since']:
+                    resumed_records.setdefault(key, []).extend(records)
+            for email, principal_policy in segment['principals'].items():
+                principals[email] = principal_policy_from_json(principal_policy)
+        self.searches = searches
+        self.principals = principals
+        self.org_export = saved.get('org_export')
+        self._resumed_records = resumed_records
+        self._segments = saved['segments']
+        self._next_segment = max(self._segments, default=-1) + 1
+        print(f"Resuming from the checkpoint at {self.location}: "
+              f"{len(self.searches)} searches and {len(self.principals)} "
+              "analyzed principals")
+        return True
+
+    def save(self):
+        """
+        Save the progress made since the last save. The new records are
+        handed over under the lock and serialized outside of it, so the
+        threads adding pages and principals don't wait on the save
+        """
+        with self._save_lock:
+            with self._lock:
+                records, self._new_records = self._new_records, {}
+                principals, self._new_principals = self._new_principals, {}
+                searches = {
+                    key: dict(search) for key, search in self.searches.items()
+                }
+                org_export = self.org_export
+                index = None
+                if records or principals:
+                    index = self._next_segment
+                    self._next_segment += 1
+                self._last_save = time.monotonic()
+            segments = self._segments
+            try:
+                if index is not None:
+                    write_bytes_to_location(
+                        self.segment_location(index),
+                        gzip.compress(
+                            json.dumps(
+                                {
+                                    'records': records,
+                                    'principals': principals
+                                },
+                                separators=(',', ':')).encode('utf-8')))
+                    segments = segments + [index]
+                write_bytes_to_location(
+                    self.location,
+                    gzip.compress(
+                        json.dumps(
+                            {
+                                'version': CHECKPOINT_VERSION,
+                                'fingerprint': self.fingerprint,
+                                'segments': segments,
+                                'searches': searches,
+                                'org_export': org_export
+                            },
+                            separators=(',', ':')).encode('utf-8')))
+            except BaseException:
+                ## Hand the progress back so the next save writes it, unless
+                # the search was started over in the meantime
+                with self._lock:
+                    for key, key_records in records.items():
+                        if (key in self.searches and
+                                self.searches[key]['since'] <= index):
+                            self._new_records[key] = (
+                                key_records + self._new_records.get(key, []))
+                    principals.update(self._new_principals)
+                    self._new_principals = principals
+                raise
+            self._segments = segments
+
+    def set_org_export(self, location):
+        """
+        Record that the org wide analysis was exported to location and save
+        it right away, the export is the slowest step of the run
+        """
+        with self._lock:
+            self.org_export = location
+        self.save()
+
+    def clear(self):
+        """
+        Remove the saved progress once the run is done
+        """
+        delete_location(self.location)
+        for index in sorted(
+                set(range(self._next_segment)) | set(self._stale_segments)):
+            delete_location(self.segment_location(index))
+
+    def check_time_limit(self):
+        """
+        Raise CheckpointTimeLimit if the run is past its time limit
+        """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise CheckpointTimeLimit(
+                f"Reached the time limit, the progress is saved to "
+                f"{self.location}")
+
+    def _progress(self):
+        """
+        Save the progress if the last save is older than the interval, and
+        stop the run past the time limit
+        """
+        with self._lock:
+            save_due = time.monotonic() - self._last_save >= self.interval
+            if save_due:
+                ## Only one of the threads saves
+                self._last_save = time.monotonic()
+        if save_due:
+            self.save()
+        self.check_time_limit()
+
+    def get_search(self, key):
+        """
+        Return the (encoded records, next page token, done) saved for a
+        search. The records are only handed out once
+        """
+        with self._lock:
+            search = self.searches.get(key)
+            if search is None:
+                return [], None, False
+            return (self._resumed_records.pop(key, []), search['page_token'],
+                    search['done'])
+
+    def add_page(self, key, records, page_token):
+        """
+        Record the encoded records of a fetched page and the token of the
+        page after it, an empty token finishes the search
+        """
+        with self._lock:
+            search = self.searches.setdefault(key, {
+                'page_token': None,
+                'done': False,
+                'since': self._next_segment
+            })
+            if records:
+                self._new_records.setdefault(key, []).extend(records)
+            search['page_token'] = page_token or None
+            search['done'] = not page_token
+        self._progress()
+
+    def reset_search(self, key):
+        """
+        Forget the saved pages of a search
+        """
+        with self._lock:
+            self.searches.pop(key, None)
+            self._resumed_records.pop(key, None)
+            self._new_records.pop(key, None)
+
+    def get_principal(self, email):
+        """
+        Return a (found, principal policy) tuple for a principal analyzed
+        by an earlier run
+        """
+        with self._lock:
+            if email in self.principals:
+                return True, self.principals[email]
+            return False, None
+
+    def add_principal(self, email, principal_policy):
+        """
+        Record the result of the analysis of a principal (None if it has
+        no entitlements)
+        """
+        with self._lock:
+            self._new_principals[email] = principal_policy
+        self._progress()
+
+
+## Checkpoint of the current run, None when checkpointing is off
+_RUN_CHECKPOINT = None
+
+
+def get_run_checkpoint():
+    """Return the checkpoint of the current run, or None"""
+    return _RUN_CHECKPOINT
+
+
+def set_run_checkpoint(checkpoint):
+    """
+    Replace the checkpoint of the current run, returns the previous one so
+    it can be restored
+    """
+    global _RUN_CHECKPOINT
+    previous = _RUN_CHECKPOINT
+    _RUN_CHECKPOINT = checkpoint
+    return previous
+
+
+def get_policy_for_identity(identity_info, org_id=None, client=None, uid=None):
+    """
+    Get Iam policies with the iam-policy-analyze api, which also shows
+    group inherited policies. If user-a is part of group-a, then a policy
+    that is using the group will be listed for user-a. Returns None if the
+    analysis didn't find any entitlements for the identity. The analysis
+    results are served from the analysis cache when it's turned on, or
+    from the org wide analysis when one is loaded. The uid defaults to the
+    email of the identity. Only users are analyzed, the other members get
+    the entitlements of their own bindings from the parsing
+    """
+    if uid is None:
+        uid = identity_info.email
+    if get_org_analysis() is not None:
+        return get_org_analysis().get_policy(identity_info, uid)
+    cache = get_analysis_cache()
+    if cache is not None:
+        found, cached_policy = cache.get(org_id, identity_info.email)
+        if found:
+            return cached_policy
+
+    if client is None:
+        client = get_client_provider().asset_client()
+    parent = f"organizations/{org_id}"
+
+    # Build analysis query
+    analysis_query = asset_v1.IamPolicyAnalysisQuery()
+    analysis_query.scope = parent
+    analysis_query.identity_selector.identity = f"user:{identity_info.email}"
+    analysis_query.options.expand_groups = True
+    analysis_query.options.output_group_edges = True
+
+    throttle_api_call('analyze_iam_policy', org_id)
+    start = time.perf_counter()
+    response = client.analyze_iam_policy(
+        request={"analysis_query": analysis_query}, retry=ANALYSIS_RETRY)
+    analysis_results = response.main_analysis.analysis_results
+    get_run_metrics().record_api_call('analyze_iam_policy',
+                                      len(analysis_results),
+                                      time.perf_counter() - start)
+
+    ## Read the fields straight off the results instead of converting the
+    # whole response to a dictionary first
+    entitlements = []
+    for result in analysis_results:
+        rsc_type, rsc_name = result.attached_resource_full_name.split('/')[-2:]
+        ## Skip the "Policy Resource"
+        if rsc_type == "Policy":
+            continue
+        group_edges = result.identity_list.group_edges
+        group_name = (group_edges[0].source_node.replace(':', '_')
+                      if group_edges else '')
+        entitlements.append(
+            EntitlementRecord(result.iam_binding.role.replace('roles/', ''),
+                              rsc_type, rsc_name, group_name))
+
+    principal_policy = None
+    if entitlements:
+        principal_policy = {
+            "First_Name": identity_info.first_name,
+            "Last_Name": identity_info.last_name,
+            "UniqueID": uid,
+            "Email": identity_info.email,
+            "Entitlement": entitlements,
+            "AppOwner": APP_OWNER
+        }
+    if cache is not None:
+        cache.put(org_id, identity_info.email, principal_policy)
+    return principal_policy
+
+
+def analyze_identities(identities, org_id, max_workers=ANALYSIS_CONCURRENCY):
+    """
+    Run the iam-policy-analyze api for a list of user identities through a
+    bounded pool of workers sharing the process wide client. Returns a
+    dictionary of email -> principal policy in the same order as the passed
+    in list. With a run checkpoint the users analyzed by an earlier run
+    are skipped and every finished analysis is recorded
+    """
+    client = None
+    if get_org_analysis() is None:
+        client = get_client_provider().asset_client()
+    checkpoint = get_run_checkpoint()
+
+    def analyze(identity):
+        if checkpoint is None:
+            return get_policy_for_identity(identity,
+                                           org_id=org_id,
+                                           client=client)
+        found, principal_policy = checkpoint.get_principal(identity.email)
+        if not found:
+            checkpoint.check_time_limit()
+            principal_policy = get_policy_for_identity(identity,
+                                                       org_id=org_id,
+                                                       client=client)
+            checkpoint.add_principal(identity.email, principal_policy)
+        return principal_policy
+
+    with get_run_metrics().stage('analyze_identities'), ThreadPoolExecutor(
+            max_workers=max(1, max_workers)) as executor:
+        ## map() yields the results in submission order, so the merge is
+        # deterministic no matter which analysis finishes first
+        results = executor.map(analyze, identities)
+        try:
+            return {
+                identity.email: result
+                for identity, result in zip(identities, results)
+            }
+        except BaseException:
+            ## Don't start the analyses that are still queued
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+## per_user makes an analyze_iam_policy call per user, org_export a single
+# org wide analysis export
+ANALYSIS_MODES = ('per_user', 'org_export')
+
+## Seconds to wait for an org wide analysis export to finish
+ANALYSIS_EXPORT_TIMEOUT = 3600
+
+
+def analysis_field(message, camel_case, under_score):
+    """
+    Get a field of an analysis result, the exports use camelCase keys and
+    the client libraries use under_scores so both are supported
+    """
+    if camel_case in message:
+        return message[camel_case]
+    return message.get(under_score)
+
+
+class OrgAnalysis:
+    """
+    Entitlements of every user in the organization, parsed from the result
+    of a single org wide iam-policy-analyze export with the groups
+    expanded. It stands in for the per user analysis calls
+    """
+
+    def __init__(self):
+        self.entitlements = {}
+
+    def add_result(self, result):
+        """
+        Add the entitlements an analysis result (as a dictionary) grants to
+        the users in its identity list
+        """
+        resource = analysis_field(result, 'attachedResourceFullName',
+                                  'attached_resource_full_name')
+        rsc_type = resource.split('/')[-2]
+        rsc_name = resource.split('/')[-1]
+        ## Skip the "Policy Resource"
+        if rsc_type == "Policy":
+            return
+        binding = analysis_field(result, 'iamBinding', 'iam_binding')
+        role = binding['role'].replace('roles/', '')
+        members = set(binding.get('members') or ())
+        identity_list = analysis_field(result, 'identityList',
+                                       'identity_list') or {}
+        parents = {}
+        for edge in analysis_field(identity_list, 'groupEdges',
+                                   'group_edges') or ():
+            parents.setdefault(
+                analysis_field(edge, 'targetNode', 'target_node'),
+                []).append(analysis_field(edge, 'sourceNode', 'source_node'))
+        for identity in identity_list.get('identities') or ():
+            if identity['name'].startswith('user:'):
+                self.entitlements.setdefault(
+                    identity['name'][len('user:'):], []).append(
+                        EntitlementRecord(
+                            role, rsc_type, rsc_name,
+                            self._via_group(identity['name'], members,
+                                            parents)))
+
+    @staticmethod
+    def _via_group(identity, members, parents):
+        """
+        Find the group of the binding the identity inherits the binding
+        from by walking up the group edges, empty if it's a direct member
+        """
+        if identity in members:
+            return ''
+        pending = deque(parents.get(identity, ()))
+        seen = set()
+        while pending:
+            group = pending.popleft()
+            if group in members:
+                return group.replace(':', '_')
+            if group not in seen:
+                seen.add(group)
+                pending.extend(parents.get(group, ()))
+        ## The binding's group isn't in the edges, use the closest group
+        if identity in parents:
+            return parents[identity][0].replace(':', '_')
+        return ''
+
+    def get_policy(self, identity_info, uid):
+        """
+        Return the principal policy of a user, None if the analysis didn't
+        find any entitlements for the user
+        """
+        entitlements = self.entitlements.get(identity_info.email)
+        if not entitlements:
+            return None
+        return {
+            "First_Name": identity_info.first_name,
+            "Last_Name": identity_info.last_name,
+            "UniqueID": uid,
+            "Email": identity_info.email,
+            "Entitlement": list(entitlements),
+            "AppOwner": APP_OWNER
+        }
+
+
+def iter_analysis_object(reader):
+    """
+    Walk the json object at the position of a JsonTextReader and yield
+    the analysis results in it: an analysis response (or its mainAnalysis)
+    has its analysisResults array decoded one result at a time, any other
+    object is an analysis result itself
+    """
+    reader.expect('{')
+    record = {}
+    wrapped = False
+    while reader.peek(',') != '}':
+        key = reader.value()
+        reader.expect(':')
+        if key in ('mainAnalysis', 'main_analysis') and reader.peek() == '{':
+            yield from iter_analysis_object(reader)
+            wrapped = True
+        elif key in ('analysisResults',
+                     'analysis_results') and reader.peek() == '[':
+            reader.expect('[')
+            while reader.peek(',') != ']':
+                yield reader.value()
+            reader.expect(']')
+            wrapped = True
+        else:
+            record[key] = reader.value()
+    reader.expect('}')
+    if not wrapped:
+        yield record
+
+
+def iter_analysis_results(json_file):
+    """
+    Yield the analysis results of an iam-policy-analyze export (a filename
+    or a binary file object) one at a time. The file can hold the results
+    as a json array or as json lines, or hold whole analysis responses,
+    whose results are yielded in turn without decoding the responses whole
+    """
+
+    def iter_record(reader):
+        if reader.peek() == '{':
+            yield from iter_analysis_object(reader)
+        else:
+            yield reader.value()
+
+    yield from iter_json_records(json_file, iter_record=iter_record)
+
+
+def load_org_analysis(location):
+    """
+    Stream-parse an iam-policy-analyze export (a local file or a
+    gs://bucket/object uri) into an OrgAnalysis. Exports in a bucket are
+    read as a stream, nothing is written to the local disk (in a cloud
+    function /tmp is kept in memory)
+    """
+    org_analysis = OrgAnalysis()
+    with get_run_metrics().stage('load_analysis'):
+        if location.startswith('gs://'):
+            gcp_bucket, object_name = split_gcs_uri(location)
+            storage_client = get_client_provider().storage_client()
+            blob = storage_client.bucket(gcp_bucket).blob(object_name)
+            with blob.open('rb') as blob_handler:
+                for result in iter_analysis_results(blob_handler):
+                    org_analysis.add_result(result)
+        else:
+            for result in iter_analysis_results(location):
+                org_analysis.add_result(result)
+    print(f"Loaded the analysis of {len(org_analysis.entitlements)} users "
+          f"from {location}")
+    return org_analysis
+
+
+def export_org_analysis(org_id, gcs_uri, timeout=ANALYSIS_EXPORT_TIMEOUT):
+    """
+    Run a single org wide iam-policy-analyze with the groups expanded as a
+    long running operation that writes the results to gcs_uri, and wait
+    for it to finish
+    """
+    client = get_client_provider().asset_client()
+    analysis_query = asset_v1.IamPolicyAnalysisQuery()
+    analysis_query.scope = f"organizations/{org_id}"
+    analysis_query.options.expand_groups = True
+    analysis_query.options.output_group_edges = True
+    output_config = asset_v1.IamPolicyAnalysisOutputConfig()
+    output_config.gcs_destination.uri = gcs_uri
+
+    throttle_api_call('analyze_iam_policy_longrunning', org_id)
+    start = time.perf_counter()
+    with get_run_metrics().stage('export_analysis'):
+        try:
+            operation = client.analyze_iam_policy_longrunning(request={
+                "analysis_query": analysis_query,
+                "output_config": output_config
+            })
+            operation.result(timeout=timeout)
+        except (GoogleAPIError, googleapiclient.errors.HttpError) as err:
+            print(f'API Error: {err}')
+            exit(0)
+    get_run_metrics().record_api_call('analyze_iam_policy_longrunning', 0,
+                                      time.perf_counter() - start)
+    print(f"Exported the org wide analysis to {gcs_uri}")
+
+
+## Loaded org wide analysis, when it's set the users are looked up in it
+# instead of being analyzed one by one
+_ORG_ANALYSIS = None
+
+
+def get_org_analysis():
+    """Return the loaded org wide analysis, or None"""
+    return _ORG_ANALYSIS
+
+
+def set_org_analysis(org_analysis):
+    """
+    Set the org wide analysis used by get_policy_for_identity, returns the
+    previous one so it can be restored
+    """
+    global _ORG_ANALYSIS
+    previous = _ORG_ANALYSIS
+    _ORG_ANALYSIS = org_analysis
+    return previous
+
+
+def users_are_analyzed(org_id):
+    """
+    Users are analyzed in remote mode, or when an org wide analysis is
+    loaded. Otherwise they only get the entitlements of their own bindings
+    """
+    return org_id is not None or get_org_analysis() is not None
+
+
+## Immutable identity parsed out of a policy member, the same record is
+# shared by all the bindings that reference the member
+IdentityRecord = namedtuple('IdentityRecord',
+                            ['sa_type', 'email', 'first_name', 'last_name'])
+
+## Members of these types are not reported on
+IGNORED_SA_TYPES = frozenset(
+    ('projectOwner', 'projectEditor', 'projectViewer', 'group'))
+
+NOT_USED_IDENTITY = IdentityRecord("notUsed", None, None, None)
+
+
+@functools.lru_cache(maxsize=None)
+def get_identity_info(member):
+    """
+    Create an identity record with the information about the identity of a
+    policy member. The results are memoized so every member string is only
+    parsed once per run, clear_parse_memos drops them when the run ends
+    """
+    colon_counter = member.count(':')
+    if colon_counter == 1:
+        sa_type, sa_name = member.split(':')
+        sa_other = "notUsed"
+    elif colon_counter == 2:
+        sa_other, sa_type, sa_name = member.split(':')
+    else:
+        ## Usually no colons means it's allUsers,
+        # which is not in email format
+        sa_name = member
+        sa_type = member
+        sa_other = "notUsed"
+
+    if sa_type in IGNORED_SA_TYPES or sa_other == "deleted":
+        return NOT_USED_IDENTITY
+
+    if sa_type != "allUsers":
+        f_name = l_name = sa_name.split('@')[0]
+    else:
+        f_name = l_name = sa_name
+
+    return IdentityRecord(sys.intern(sa_type), sys.intern(sa_name),
+                          sys.intern(f_name), sys.intern(l_name))
+
+
+@functools.lru_cache(maxsize=None)
+def role_name(role):
+    """
+    The role as it's shown in the entitlements, without the roles/ prefix.
+    There are few distinct roles, so they are memoized
+    """
+    return sys.intern(role.replace('roles/', ''))
+
+
+def clear_parse_memos():
+    """
+    Drop the memoized identities and roles, so a warm process (a reused
+    cloud function instance or the service) doesn't keep every member it
+    has ever seen
+    """
+    get_identity_info.cache_clear()
+    role_name.cache_clear()
+
+
+def iter_policy_bindings(all_iam_policies_dictionary):
+    """
+    Walk the IAM policies and yield an (entitlement, identities) tuple for
+    every binding with members that should be reported on: the
+    entitlement the binding gives and the identities of those members. The
+    resource part of the entitlement is worked out once per policy and the
+    entitlement once per binding, all the members share it
+    """
+    for iam_policy in all_iam_policies_dictionary:
+        ## The Policy Resource type and the other excluded types are
+        # already dropped by filter_iam_policy
+        rsc_type = sys.intern(iam_policy.asset_type.split('/')[-1])
+        rsc_name = sys.intern(iam_policy.resource.split('/')[-1])
+        for binding in iam_policy.bindings:
+            identities = [
+                identity for identity in map(get_identity_info, binding.members)
+                if identity is not NOT_USED_IDENTITY
+            ]
+            if identities:
+                yield EntitlementRecord(role_name(binding.role), rsc_type,
+                                        rsc_name, ''), identities
+
+
+def add_binding_members(accumulator,
+                        entitlement,
+                        identities,
+                        sa_index,
+                        reserve_users=False):
+    """
+    Add the entitlement a binding gives to its member identities to the
+    EntitlementAccumulator, gcp owned service accounts are skipped. The
+    entitlement is interned once for all of them. With reserve_users the
+    users are only reserved, to be analyzed later. Returns the users that
+    were newly reserved, in the order of the members
+    """
+    reserved_users = []
+    entitlement_id = None
+    for identity in identities:
+        if identity.sa_type == 'user':
+            if reserve_users:
+                ## Reserve the slot so the output keeps the
+                # order in which the users were first seen
+                if accumulator.reserve(identity.email):
+                    reserved_users.append(identity)
+                continue
+            uid = identity.email
+        else:
+            uid = get_uid_from_email(identity.email, sa_index)
+            if uid == 'gcp_owned':
+                continue
+        if entitlement_id is None:
+            entitlement_id = accumulator.intern(entitlement)
+        accumulator.add_member(identity, uid, entitlement_id)
+    return reserved_users
+
+
+def parse_assets_output(all_iam_policies_dictionary,
+                        all_sas_dictionary,
+                        gcp_org_id=None,
+                        analysis_workers=ANALYSIS_CONCURRENCY):
+    """
+    Take input from `gcloud asset search-all-iam-policies` and
+    `gcloud asset search-all-resources --asset-types='iam.googleapis.com/ServiceAccount'`
+    and produce an EntitlementAccumulator of those files merged, which
+    reads like a dictionary of email -> principal policy. In remote mode the
+    users are collected first and analyzed concurrently at the end
+    """
+    output_dict = EntitlementAccumulator()
+    users_to_analyze = []
+    sa_index = build_sa_index(all_sas_dictionary)
+    analyze_users = users_are_analyzed(gcp_org_id)
+    # ignored_sa_accounts = set(('deleted'))
+    for entitlement, identities in iter_policy_bindings(
+            all_iam_policies_dictionary):
+        users_to_analyze.extend(
+            add_binding_members(output_dict, entitlement, identities, sa_index,
+                                analyze_users))
+
+    if users_to_analyze:
+        analyzed = analyze_identities(users_to_analyze, gcp_org_id,
+                                      analysis_workers)
+        add_analyzed_policies(output_dict, analyzed)
+
+    # print (json.dumps(output_dict, indent=2, default=str))
+    return output_dict
+
+
+def add_analyzed_policies(output_dict, analyzed):
+    """
+    Fill in the reserved users of an EntitlementAccumulator with the
+    results of analyze_identities, the users without entitlements are
+    dropped
+    """
+    for email, identity_policy in analyzed.items():
+        if identity_policy is None:
+            output_dict.discard(email)
+        else:
+            output_dict.add_policy(identity_policy)
+
+
+## Size of the byte ranges of the json export a worker process parses at
+# a time
+PARSE_RANGE_SIZE = 16 * 1024 * 1024
+
+## Service account index and filters of the worker processes, set when
+# they start
+_WORKER_SA_INDEX = None
+_WORKER_ANALYZE_USERS = False
+_WORKER_ASSET_FILTERS = DEFAULT_ASSET_FILTERS
+
+
+def _init_parse_worker(sa_index,
+                       analyze_users=False,
+                       asset_filters=DEFAULT_ASSET_FILTERS):
+    """Keep the service account index and filters in the worker process"""
+    global _WORKER_SA_INDEX, _WORKER_ANALYZE_USERS, _WORKER_ASSET_FILTERS
+    _WORKER_SA_INDEX = sa_index
+    _WORKER_ANALYZE_USERS = analyze_users
+    _WORKER_ASSET_FILTERS = asset_filters
+
+
+def _parse_json_range(iam_json_filename, start, end, in_array):
+    """
+    Read, decode and parse a byte range of the IAM policies export in a
+    worker process. Returns the tables of an EntitlementAccumulator, users
+    that are analyzed afterwards are only reserved
+    """
+    with open(iam_json_filename, 'rb') as json_file_handler:
+        json_file_handler.seek(start)
+        contents = json_file_handler.read(end - start)
+    iam_policies = filter_iam_policies(
+        map(policy_record_from_dict,
+            iter_json_records(io.BytesIO(contents), in_array)),
+        _WORKER_ASSET_FILTERS)
+    output_dict = EntitlementAccumulator()
+    for entitlement, identities in iter_policy_bindings(iam_policies):
+        add_binding_members(output_dict, entitlement, identities,
+                            _WORKER_SA_INDEX, _WORKER_ANALYZE_USERS)
+    return output_dict.table()
+
+
+def parse_assets_output_parallel(iam_json_filename,
+                                 all_sas_dictionary,
+                                 workers,
+                                 asset_filters=DEFAULT_ASSET_FILTERS,
+                                 range_size=PARSE_RANGE_SIZE):
+    """
+    Multi-process version of parse_assets_output for local mode, straight
+    from the IAM policies export. The export is split into byte ranges of
+    whole records that the worker processes read, decode, filter and parse
+    themselves, the main process only merges their compact tables back in
+    order, so the output is exactly the same as the one of
+    parse_assets_output. Exports whose records can't be split that way are
+    parsed in this process. When an org wide analysis is loaded the users
+    are looked up in it at the end
+    """
+    ## Spread small exports over all the workers too
+    range_size = min(
+        range_size,
+        max(JSON_READ_SIZE,
+            os.path.getsize(iam_json_filename) // workers))
+    split = split_json_records(iam_json_filename, range_size)
+    if split is None:
+        print(f"The records of {iam_json_filename} can't be split, "
+              "parsing them in a single process")
+        return parse_assets_output(
+            filter_iam_policies(
+                map(policy_record_from_dict,
+                    iter_json_records(iam_json_filename)), asset_filters),
+            all_sas_dictionary)
+    ranges, in_array = split
+
+    output_dict = EntitlementAccumulator()
+    sa_index = build_sa_index(all_sas_dictionary)
+    analyze_users = users_are_analyzed(None)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_parse_worker,
+                             initargs=(sa_index, analyze_users,
+                                       asset_filters)) as executor:
+        ## Only keep a couple of ranges per worker in flight so the parsed
+        # tables don't pile up ahead of the merge
+        pending = deque()
+        for start, end in ranges:
+            pending.append(
+                executor.submit(_parse_json_range, iam_json_filename, start,
+                                end, in_array))
+            while len(pending) > 2 * workers:
+                output_dict.merge_table(pending.popleft().result())
+        while pending:
+            output_dict.merge_table(pending.popleft().result())
+
+    if analyze_users:
+        users_to_analyze = [
+            get_identity_info(f"user:{email}")
+            for email in output_dict.reserved()
+        ]
+        add_analyzed_policies(output_dict,
+                              analyze_identities(users_to_analyze, None))
+
+    return output_dict
+
+
+def stream_assets_output(all_iam_policies_dictionary,
+                         all_sas_dictionary,
+                         gcp_org_id=None,
+                         analysis_workers=ANALYSIS_CONCURRENCY):
+    """
+    Streaming version of parse_assets_output. The policies are consumed one
+    at a time and each principal policy is yielded as soon as it is final:
+    analyzed users as their analysis finishes (in the order they were first
+    seen) and the rest once all the policies have been walked. Only the
+    per principal state is kept in memory
+    """
+    output_dict = EntitlementAccumulator()
+    analyses = deque()
+    sa_index = build_sa_index(all_sas_dictionary)
+    client = None
+    if gcp_org_id is not None and get_org_analysis() is None:
+        client = get_client_provider().asset_client()
+    analyze_users = users_are_analyzed(gcp_org_id)
+    with ThreadPoolExecutor(max_workers=max(1, analysis_workers)) as executor:
+        try:
+            for entitlement, identities in iter_policy_bindings(
+                    all_iam_policies_dictionary):
+                ## The reserved users are left out of the output_dict values,
+                # their principal policies come from the analysis
+                for identity in add_binding_members(output_dict, entitlement,
+                                                    identities, sa_index,
+                                                    analyze_users):
+                    analyses.append(
+                        executor.submit(get_policy_for_identity,
+                                        identity,
+                                        org_id=gcp_org_id,
+                                        client=client))
+
+                ## Hand out the analyses that are already done without
+                # waiting on the ones still in flight
+                while analyses and analyses[0].done():
+                    identity_policy = analyses.popleft().result()
+                    if identity_policy is not None:
+                        yield render_principal_policy(identity_policy)
+
+            while analyses:
+                identity_policy = analyses.popleft().result()
+                if identity_policy is not None:
+                    yield render_principal_policy(identity_policy)
+        except BaseException:
+            ## A failed analysis, a failed write or the reader stopping early
+            # (GeneratorExit) doesn't wait for the analyses still queued
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    yield from output_dict.values()
+
+
+## Size of the chunks sent by the resumable uploads, it has to be a
+# multiple of 256 KiB
+OUTPUT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@contextlib.contextmanager
+def open_output_sink(location, chunk_size=None, binary=False):
+    """
+    Open a text stream to write the results to. A gs://bucket/object uri is
+    streamed straight into a resumable upload, chunk_size bytes at a time
+    (each chunk is retried on its own), without staging anything on disk.
+    Anything else is written to the local filesystem. If the location ends
+    with .gz the contents are gzip compressed. The upload is only finalized
+    if the writing finished without errors. Pass binary=True to get a
+    binary stream instead of a text one
+    """
+    if chunk_size is None:
+        chunk_size = int(os.getenv("OUTPUT_CHUNK_SIZE", str(OUTPUT_CHUNK_SIZE)))
+    compress = location.endswith('.gz')
+    if location.startswith('gs://'):
+        gcp_bucket, object_name = split_gcs_uri(location)
+        storage_client = get_client_provider().storage_client()
+        blob = storage_client.bucket(gcp_bucket).blob(object_name)
+        if compress:
+            blob.content_encoding = 'gzip'
+        raw_sink = blob.open('wb',
+                             chunk_size=chunk_size,
+                             ignore_flush=True,
+                             retry=DEFAULT_RETRY)
+    else:
+        raw_sink = open(location, 'wb')
+
+    ## The raw sink is entered last so on an error the upload is cancelled
+    # instead of finalized
+    with raw_sink:
+        if compress:
+            binary_sink = gzip.GzipFile(fileobj=raw_sink, mode='wb')
+        else:
+            binary_sink = raw_sink
+        if binary:
+            yield binary_sink
+        else:
+            text_sink = io.TextIOWrapper(binary_sink,
+                                         encoding='utf-8',
+                                         newline='')
+            yield text_sink
+            text_sink.flush()
+            text_sink.detach()
+        if compress:
+            binary_sink.close()
+
+
+def write_dictionary_to_csv(dictionary, filename):
+    '''
+    Write the dictionary out to a csv file
+    '''
+    write_rows_to_csv(dictionary.values(), filename)
+
+
+def write_rows_to_csv(principal_policies, filename):
+    '''
+    Write the principal policies out to a csv file, each row is written as
+    soon as it is handed over so the rows can come from a generator. The
+    filename can be a local path or a gs://bucket/object uri
+    '''
+    csv_columns = [
+        'First_Name', 'Last_Name', 'UniqueID', 'Entitlement', 'Email',
+        'AppOwner'
+    ]
+    csv_file = filename
+    try:
+        with open_output_sink(csv_file) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
+            writer.writeheader()
+            for sa_value in principal_policies:
+                writer.writerow(
+                    dict(sa_value,
+                         Entitlement=";".join(
+                             map(format_entitlement, sa_value['Entitlement']))))
+    except IOError:
+        print("I/O error, can't write out CSV file")
+
 
+OUTPUT_FORMATS = ('csv', 'parquet', 'jsonl')
 
-def get_all_iam_policies(org_id):
+## Columns of the normalized (one row per principal and entitlement)
+# output formats
+NORMALIZED_COLUMNS = [
+    'Email', 'First_Name', 'Last_Name', 'UniqueID', 'AppOwner', 'Role',
+    'Resource_Type', 'Resource_Name', 'Via'
+]
+
+## The columns with few distinct values are dictionary encoded
+DICTIONARY_COLUMNS = ('AppOwner', 'Role', 'Resource_Type', 'Resource_Name',
+                      'Via')
+
+## Number of rows buffered before a parquet row group is written out
+PARQUET_ROW_GROUP_SIZE = 100000
+
+
+def iter_normalized_rows(principal_policies):
     """
-    Given a service account get all the IAM policies attached to
-    that service account
+    Flatten the principal policies into one tuple per principal and
+    entitlement, with the values in the NORMALIZED_COLUMNS order
     """
-    scope = f"organizations/{org_id}"
-    client = asset_v1.AssetServiceClient()
+    for principal_policy in principal_policies:
+        identity_values = (principal_policy['Email'],
+                           principal_policy['First_Name'],
+                           principal_policy['Last_Name'],
+                           principal_policy['UniqueID'],
+                           principal_policy['AppOwner'])
+        for entitlement in principal_policy['Entitlement']:
+            yield identity_values + tuple(entitlement)
+
+
+def write_rows_to_jsonl(principal_policies, filename):
+    '''
+    Write the principal policies out as json lines, one line per principal
+    and entitlement. Use a filename ending with .gz to compress it
+    '''
     try:
-        response = client.search_all_iam_policies(request={"scope": scope})
-    except (GoogleAPIError, googleapiclient.errors.HttpError) as err:
-        print(f'API Error: {err}')
+        with open_output_sink(filename) as jsonl_file:
+            for row in iter_normalized_rows(principal_policies):
+                jsonl_file.write(json.dumps(dict(zip(NORMALIZED_COLUMNS, row))))
+                jsonl_file.write('\n')
+    except IOError:
+        print("I/O error, can't write out json lines file")
+
+
+def write_rows_to_parquet(principal_policies,
+                          filename,
+                          row_group_size=PARQUET_ROW_GROUP_SIZE):
+    '''
+    Write the principal policies out as a parquet file, one row per
+    principal and entitlement. The rows are written out in row groups as
+    they come in so only one row group is kept in memory
+    '''
+    if pyarrow is None:
+        print("The parquet output needs pyarrow, install it with " +
+              "'pip3 install pyarrow'")
         exit(0)
-    ## converting protobuf to dictionary
-    # https://github.com/googleapis/python-vision/issues/70#issuecomment-749135327
-    serializable_assets = [proto.Message.to_dict(asset) for asset in response]
-    return serializable_assets
+    schema = pyarrow.schema([
+        (column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+         if column in DICTIONARY_COLUMNS else pyarrow.string())
+        for column in NORMALIZED_COLUMNS
+    ])
 
+    def write_row_group(writer, columns):
+        writer.write_table(
+            pyarrow.Table.from_arrays([
+                pyarrow.array(values, type=field.type)
+                for values, field in zip(columns, schema)
+            ],
+                                      schema=schema))
 
-def upload_content_gcp_bucket(gcp_bucket, dest_filename, file_contents):
-    """Uploads a file to the bucket by using it's contents"""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(gcp_bucket)
-    blob = bucket.blob(dest_filename)
+    try:
+        with open_output_sink(filename, binary=True) as parquet_file:
+            writer = pyarrow.parquet.ParquetWriter(parquet_file, schema)
+            columns = [[] for _ in NORMALIZED_COLUMNS]
+            for row in iter_normalized_rows(principal_policies):
+                for values, value in zip(columns, row):
+                    values.append(value)
+                if len(columns[0]) >= row_group_size:
+                    write_row_group(writer, columns)
+                    columns = [[] for _ in NORMALIZED_COLUMNS]
+            if columns[0]:
+                write_row_group(writer, columns)
+            writer.close()
+    except IOError:
+        print("I/O error, can't write out parquet file")
 
-    blob.upload_from_string(file_contents)
 
+def write_results(principal_policies, filename, output_format='csv'):
+    '''
+    Write the principal policies out in one of the OUTPUT_FORMATS
+    '''
+    if output_format == 'parquet':
+        write_rows_to_parquet(principal_policies, filename)
+    elif output_format == 'jsonl':
+        write_rows_to_jsonl(principal_policies, filename)
+    else:
+        write_rows_to_csv(principal_policies, filename)
 
-def upload_file_gcp_bucket(gcp_bucket, dest_filename, source_file):
-    """Uploads a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(gcp_bucket)
-    blob = bucket.blob(dest_filename)
 
-    blob.upload_from_filename(source_file)
+## Bumped whenever the layout of the incremental state changes, older
+# states are ignored and rebuilt
+INCREMENTAL_STATE_VERSION = 3
 
+## Entitlements coming from the iam-policy-analyze api aren't tied to a
+# single policy, in the incremental state they are kept under this key
+ANALYSIS_KEY = '*'
 
-def import_json_as_dictionary(filename):
+
+def new_incremental_state():
     """
-    Given a json file import it and return the contents as a dictionary
+    Create an empty incremental state. The state keeps a fingerprint of
+    every policy that was processed and, per principal, the entitlements
+    grouped by the resource that grants them, so a changed policy only
+    touches the principals it mentions. It also keeps the resource name of
+    every project by its number (feeds name projects by number) and the
+    service account index of the last full export, so feed updates don't
+    have to search for the service accounts
     """
-    try:
-        # Check if file is utf-8 encoded
-        codecs.open(filename, encoding="utf-8", errors="strict").readline()
-        utf_8 = True
-        utf_16 = False
-    except UnicodeDecodeError:
-        utf_8 = False
+    return {
+        'version': INCREMENTAL_STATE_VERSION,
+        'policies': {},
+        'principals': {},
+        'projects': {},
+        'service_accounts': {}
+    }
 
-    if not utf_8:
-        try:
-            # Check if file is utf-16-le encoded
-            codecs.open(filename, encoding="utf-16-le",
-                        errors="strict").readline()
-            utf_16 = True
-        except UnicodeDecodeError:
-            utf_16 = False
-
-    if utf_16:
-        with open(filename, 'r', encoding='utf-16-le') as json_file_handler:
-            data = json_file_handler.read()
-            json_contents = json.loads(data.encode().decode('utf-8-sig'))
-    elif utf_8:
-        with open(filename, 'r') as json_file_handler:
-            data = json_file_handler.read()
-            json_contents = json.loads(data)
-    else:
-        print("Unable to determine file encoding, it's not utf-8 or utf-16-le")
-        exit(0)
 
-    return json_contents
+def load_incremental_state(location):
+    """
+    Load the incremental state snapshot from a local file or a gs:// uri,
+    returns None if there is no snapshot yet
+    """
+    contents = read_bytes_from_location(location)
+    if contents is None:
+        return None
+    state = json.loads(gzip.decompress(contents))
+    if state.get('version') != INCREMENTAL_STATE_VERSION:
+        print(f"Ignoring incremental state at {location}, it was saved "
+              "by a different version of the script")
+        return None
+    for principal in state['principals'].values():
+        for resource, entitlements in principal['Entitlements'].items():
+            principal['Entitlements'][resource] = [
+                EntitlementRecord(*entitlement) for entitlement in entitlements
+            ]
+    return state
 
 
-def get_uid_from_email(sa_email, all_sas_dictionary):
-    '''
-    Given an email address and all the service accounts get the uid
-    from the email attribute
-    '''
-    # pattern = "^sa-(.*)-(.*)-(.*)-(.*)@(.*)$"
-    for svc_account in all_sas_dictionary:
-        # print(svc_account)
-        ## Looks like gcloud assets --format json and
-        # python client libraries uses different
-        # formatting for keys, gcloud uses camelCase
-        # and api use under_scores, manually checking
-        # for both to support both use cases
-        if 'additional_attributes' in svc_account:
-            current_email = svc_account['additional_attributes']['email']
-            if current_email == sa_email:
-                uid = svc_account['additional_attributes']['uniqueId']
-                break
-                # match = re.search(pattern, current_email)
-                # if match:
-                #     # print(match.groups())
-                #     _env, _scope, app_id, _app, _domain_name = match.groups()
-                #     break
-                ## Uncomment below if you want to use the Description of the
-                ## service account to get the appID
-                # if 'display_name' in svc_account:
-                #     if svc_account['display_name']:
-                #         app_id = svc_account['display_name']
-                #         # print(svc_account)
-                #     else:
-                #         app_id = sa_email
-                #     ## Stop traversing the dictionary we
-                #     ## determined the service account
-                #     break
-        elif 'additionalAttributes' in svc_account:
-            current_email = svc_account['additionalAttributes']['email']
-            if current_email == sa_email:
-                uid = svc_account['additionalAttributes']['uniqueId']
-                break
-                # match = re.search(pattern, current_email)
-                # if match:
-                #     _env, _scope, app_id, _app, _domain_name = match.groups()
-                #     break
-                ## Uncomment below if you want to use the Description of the
-                ## service account to get the appID
-                # if 'displayName' in svc_account:
-                #     app_id = svc_account['displayName']
-                #     ## Stop traversing the dictionary we
-                #     ## found service account
-                #     break
-    else:
+def save_incremental_state(state, location):
+    """Save the incremental state snapshot to a local file or a gs:// uri"""
+    contents = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    write_bytes_to_location(location, gzip.compress(contents))
 
-        ## the email is not customer owned but a gcp owned agent
-        ## service account, so marking it as such
-        uid = "gcp_owned"
 
-    return uid
+def policy_fingerprint(iam_policy):
+    """Return a short hash of the parts of a policy the parsing uses"""
+    return hashlib.blake2b(repr(
+        (iam_policy.asset_type, iam_policy.bindings)).encode('utf-8'),
+                           digest_size=8).hexdigest()
 
 
-def get_policy_for_identity(identity_info,
-                            iam_policy=None,
-                            binding=None,
-                            org_id=None):
+def state_resource_name(state, resource):
     """
-    Get Iam policies with the iam-policy-analyze api, which also shows
-    group inherited policies. If user-a is part of group-a, then a policy
-    that is using the group will be listed for user-a
-    """
-    principal_policy = {}
-    if identity_info['sa_type'] == "serviceAccount" or org_id is None:
-        if 'assetType' in iam_policy:
-            rsc_type = iam_policy['assetType'].split('/')[-1]
-        elif 'asset_type' in iam_policy:
-            rsc_type = iam_policy['asset_type'].split('/')[-1]
-        rsc_name = iam_policy['resource'].split('/')[-1]
-        rsc = f"{rsc_type}_({rsc_name})"
-        role = binding['role'].replace('roles/', '')
-        principal_policy[identity_info['email']] = {
-            "First_Name": identity_info['first_name'],
-            "Last_Name": identity_info['last_name'],
-            "UniqueID": identity_info['uid'],
-            "Email": identity_info['email'],
-            "Entitlement": [f"{role}_{rsc}"],
-            "AppOwner": "a123456"
-        }
-    else:
-        client = asset_v1.AssetServiceClient()
-        parent = f"organizations/{org_id}"
-
-        # Build analysis query
-        analysis_query = asset_v1.IamPolicyAnalysisQuery()
-        analysis_query.scope = parent
-        analysis_query.identity_selector.identity = f"user:{identity_info['email']}"
-        analysis_query.options.expand_groups = True
-        analysis_query.options.output_group_edges = True
-
-        response = client.analyze_iam_policy(
-            request={"analysis_query": analysis_query})
-
-        for policy in proto.Message.to_dict(
-                response)["main_analysis"]["analysis_results"]:
-            # print (json.dumps(policy, indent=2, default=str))
-            rsc_type = policy['attached_resource_full_name'].split('/')[-2]
-            rsc_name = policy['attached_resource_full_name'].split('/')[-1]
-            role = policy['iam_binding']['role'].replace('roles/', '')
-            rsc = f"{rsc_type}_({rsc_name})"
-            if policy['identity_list']['group_edges']:
-                group_name = policy['identity_list']['group_edges'][0][
-                    'source_node'].replace(':', '_')
-                add_info = f'via_{group_name}'
-                entitlement = f"{role}_{rsc}_{add_info}"
-            else:
-                entitlement = f"{role}_{rsc}"
+    Return the name the incremental state knows a resource by. Feeds name
+    projects by number (//cloudresourcemanager.googleapis.com/projects/123)
+    while the searches name them by id, projects the state has seen are
+    mapped to their id
+    """
+    if resource.startswith(RESOURCE_MANAGER_PREFIX + 'projects/'):
+        return state['projects'].get(resource[len(RESOURCE_MANAGER_PREFIX):],
+                                     resource)
+    return resource
 
-            ## Skip the "Policy Resource"
-            if rsc_type != "Policy":
-                if identity_info['email'] in principal_policy:
-                    principal_policy[identity_info['email']][
-                        "Entitlement"].append(entitlement)
-                else:
-                    principal_policy[identity_info['email']] = {
-                        "First_Name": identity_info['first_name'],
-                        "Last_Name": identity_info['last_name'],
-                        "UniqueID": identity_info['uid'],
-                        "Email": identity_info['email'],
-                        "Entitlement": [entitlement],
-                        "AppOwner": "a123456"
-                    }
 
-            # print (json.dumps(policy, indent=2, default=str))
+def policy_record_from_feed(state, temporal_asset):
+    """
+    Given a TemporalAsset published by a Cloud Asset feed return a tuple of
+    (changed policy, deleted resource), one of which is None. The resource
+    is named the way the incremental state knows it
+    """
+    asset = temporal_asset['asset']
+    resource = state_resource_name(state, asset['name'])
+    if temporal_asset.get('deleted'):
+        return None, resource
+    policy = asset.get('iamPolicy') or asset.get('iam_policy') or {}
+    return policy_record_from_dict({
+        'assetType': asset.get('assetType', asset.get('asset_type')),
+        'resource': resource,
+        'policy': policy
+    }), None
+
 
-    return principal_policy[identity_info['email']]
+def diff_policy_snapshot(state, all_iam_policies_dictionary):
+    """
+    Compare a full export of the IAM policies with the policies in the
+    incremental state and return a tuple of (changed policies, deleted
+    resources). Only the changed policies are kept in memory
+    """
+    known_policies = state['policies']
+    seen_resources = set()
+    changed_policies = []
+    for iam_policy in all_iam_policies_dictionary:
+        seen_resources.add(iam_policy.resource)
+        if known_policies.get(
+                iam_policy.resource) != policy_fingerprint(iam_policy):
+            changed_policies.append(iam_policy)
+    deleted_resources = [
+        resource for resource in known_policies
+        if resource not in seen_resources
+    ]
+    return changed_policies, deleted_resources
 
 
-def get_identity_info(member):
+def apply_policy_changes(state,
+                         changed_policies,
+                         deleted_resources,
+                         sa_index,
+                         gcp_org_id=None,
+                         analysis_workers=ANALYSIS_CONCURRENCY):
     """
-    Create an identity dictionary to start populating information
-    about the identity
+    Update the incremental state with the changed and deleted policies and
+    return the emails of the principals that were affected. Only the
+    entitlements granted by those policies are recomputed. In remote mode
+    the affected users are analyzed again with the iam-policy-analyze api
     """
-    identity_info = {}
-    ignored_sa_types = set(
-        ('projectOwner', 'projectEditor', 'projectViewer', 'group'))
-    colon_counter = member.count(':')
-    if colon_counter == 1:
-        sa_type, sa_name = member.split(':')
-        sa_other = "notUsed"
-    elif colon_counter == 2:
-        sa_other, sa_type, sa_name = member.split(':')
-    else:
-        ## Usually no colons means it's allUsers,
-        # which is not in email format
-        sa_name = member
-        sa_type = member
-        sa_other = "notUsed"
+    principals = state['principals']
+    analyze_users = users_are_analyzed(gcp_org_id)
+    holders = {}
+    for email, principal in principals.items():
+        for resource in principal['Entitlements']:
+            holders.setdefault(resource, set()).add(email)
 
-    if sa_type not in ignored_sa_types and sa_other != "deleted":
-        if sa_type != "allUsers":
-            f_name = sa_name.split('@')[0]
-            l_name = sa_name.split('@')[0]
-        else:
-            f_name = l_name = sa_name
+    affected = set()
+    projects = state['projects']
+    for resource in deleted_resources:
+        state['policies'].pop(resource, None)
+        for project in [
+                project for project, project_resource in projects.items()
+                if project_resource == resource
+        ]:
+            del projects[project]
+        for email in holders.get(resource, ()):
+            del principals[email]['Entitlements'][resource]
+            affected.add(email)
 
-        identity_info['sa_type'] = sa_type
-        identity_info['email'] = sa_name
-        identity_info['first_name'] = f_name
-        identity_info['last_name'] = l_name
-    else:
-        identity_info["sa_type"] = "notUsed"
+    for iam_policy in changed_policies:
+        resource = iam_policy.resource
+        state['policies'][resource] = policy_fingerprint(iam_policy)
+        if iam_policy.project:
+            projects[iam_policy.project] = resource
+        policy_output = EntitlementAccumulator()
+        analyzed_users = set()
+        for entitlement, identities in iter_policy_bindings([iam_policy]):
+            for identity in add_binding_members(policy_output, entitlement,
+                                                identities, sa_index,
+                                                analyze_users):
+                ## Keep an empty entry so we know the user is mentioned
+                # in the policy, the entitlements come from the analysis
+                analyzed_users.add(identity.email)
+                policy_output.add(identity, identity.email)
 
-    return identity_info
+        for email in holders.get(resource, set()) - set(policy_output.emails()):
+            del principals[email]['Entitlements'][resource]
+            affected.add(email)
+        for email, identity_policy in policy_output.items():
+            if email not in principals:
+                principals[email] = {
+                    key: identity_policy[key]
+                    for key in ("First_Name", "Last_Name", "UniqueID", "Email",
+                                "AppOwner")
+                }
+                principals[email]['Entitlements'] = {}
+            if email in analyzed_users:
+                principals[email]['Entitlements'].setdefault(ANALYSIS_KEY, [])
+            principals[email]['Entitlements'][resource] = identity_policy[
+                'Entitlement']
+            affected.add(email)
 
+    ## Drop the principals that aren't mentioned in any policy anymore
+    for email in affected:
+        entitlements = principals[email]['Entitlements']
+        if not entitlements or list(entitlements) == [ANALYSIS_KEY]:
+            del principals[email]
 
-def parse_assets_output(all_iam_policies_dictionary,
-                        all_sas_dictionary,
-                        gcp_org_id=None):
+    users_to_analyze = [
+        get_identity_info(f"user:{email}")
+        for email in sorted(affected)
+        if email in principals and
+        ANALYSIS_KEY in principals[email]['Entitlements']
+    ]
+    if users_to_analyze:
+        analyzed = analyze_identities(users_to_analyze, gcp_org_id,
+                                      analysis_workers)
+        for email, identity_policy in analyzed.items():
+            if identity_policy is None:
+                principals[email]['Entitlements'][ANALYSIS_KEY] = []
+            else:
+                principals[email]['Entitlements'][
+                    ANALYSIS_KEY] = identity_policy['Entitlement']
+
+    return affected
+
+
+def iter_incremental_state_rows(state):
     """
-    Take input from `gcloud asset search-all-iam-policies` and
-    `gcloud asset search-all-resources --asset-types='iam.googleapis.com/ServiceAccount'`
-    and produce a dictionary of those files merged
+    Yield the principal policies kept in the incremental state in the same
+    format as parse_assets_output
     """
-    output_dict = {}
-    # ignored_sa_accounts = set(('deleted'))
-    for iam_policy in all_iam_policies_dictionary:
-        # Skip the Policy Resource type
-        if iam_policy['asset_type'] != "orgpolicy.googleapis.com/Policy":
-            if iam_policy['policy']['bindings']:
-                for binding in iam_policy['policy']['bindings']:
-                    for member in binding['members']:
-                        # print(member)
-                        identity = get_identity_info(member)
-                        if identity[
-                                'sa_type'] == 'user' and gcp_org_id is not None:
-                            identity['uid'] = identity['email']
-                            if identity['email'] not in output_dict:
-                                identity_policy = get_policy_for_identity(
-                                    identity,
-                                    iam_policy=None,
-                                    org_id=gcp_org_id)
-                                # print(identity_policy)
-                                output_dict[identity['email']] = identity_policy
-
-                        elif identity['sa_type'] != 'notUsed':
-                            if identity['sa_type'] == 'user':
-                                identity['uid'] = identity['email']
-                            else:
-                                identity['uid'] = get_uid_from_email(
-                                    identity['email'], all_sas_dictionary)
-                            if identity['uid'] != 'gcp_owned':
-                                identity_policy = get_policy_for_identity(
-                                    identity,
-                                    iam_policy=iam_policy,
-                                    binding=binding,
-                                    org_id=None)
-                                # print(identity_policy)
-                                if identity['email'] in output_dict:
-                                    # print(output_dict)
-                                    output_dict[identity['email']][
-                                        'Entitlement'].append(
-                                            identity_policy['Entitlement'][0])
-                                else:
-                                    output_dict[
-                                        identity['email']] = identity_policy
+    for principal in state['principals'].values():
+        entitlements = sorted_entitlements(
+            entitlement
+            for resource_entitlements in principal['Entitlements'].values()
+            for entitlement in resource_entitlements)
+        if entitlements:
+            row = {
+                key: value
+                for key, value in principal.items()
+                if key != 'Entitlements'
+            }
+            row['Entitlement'] = entitlements
+            yield row
 
-    # print (json.dumps(output_dict, indent=2, default=str))
-    return output_dict
 
+def run_incremental(state_location,
+                    all_iam_policies,
+                    all_svc_accts,
+                    csv_filename,
+                    previous_iam_policies=None,
+                    temporal_assets=None,
+                    gcp_org_id=None,
+                    analysis_workers=ANALYSIS_CONCURRENCY,
+                    output_format='csv',
+                    asset_filters=DEFAULT_ASSET_FILTERS,
+                    search_scopes=None):
+    """
+    Apply the differences between a full IAM policy export (or the
+    TemporalAssets sent by a Cloud Asset feed) and the saved incremental
+    state, then save the state and write out the results. Without a saved state
+    the previous export (if any) is used as the starting point and feed
+    updates fall back to the full export. The exports are expected to be
+    filtered already, the feed updates are filtered here. If some of the
+    searches of the export failed, the policies that weren't found are kept
+    instead of being deleted
+    """
+    state = load_incremental_state(state_location)
+    new_state = state is None
+    if new_state:
+        print(f"No incremental state found at {state_location}, "
+              "starting a new one")
+        state = new_incremental_state()
+        temporal_assets = None
+    if temporal_assets is None:
+        ## Feed updates reuse the index of the last full export, the
+        # service accounts are only searched for with a full export
+        state['service_accounts'] = build_sa_index(all_svc_accts)
+    sa_index = state['service_accounts']
+    if new_state and previous_iam_policies is not None:
+        apply_policy_changes(state, previous_iam_policies, [], sa_index,
+                             gcp_org_id, analysis_workers)
 
-def write_dictionary_to_csv(dictionary, filename):
-    '''
-    Write the dictionary out to a csv file
-    '''
-    csv_columns = [
-        'First_Name', 'Last_Name', 'UniqueID', 'Entitlement', 'Email',
-        'AppOwner'
-    ]
-    csv_file = filename
-    try:
-        with open(csv_file, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-            writer.writeheader()
-            for _sa, sa_value in dictionary.items():
-                sa_value['Entitlement'] = ";".join(sa_value['Entitlement'])
-                writer.writerow(sa_value)
-    except IOError:
-        print("I/O error, can't write out CSV file")
+    if temporal_assets is not None:
+        changed_policies = []
+        deleted_resources = []
+        for temporal_asset in temporal_assets:
+            iam_policy, deleted_resource = policy_record_from_feed(
+                state, temporal_asset)
+            if iam_policy is not None:
+                ## A policy the filters drop entirely is gone as far as
+                # the state is concerned
+                deleted_resource = iam_policy.resource
+                iam_policy = filter_iam_policy(iam_policy, asset_filters)
+            if iam_policy is not None:
+                changed_policies.append(iam_policy)
+            else:
+                deleted_resources.append(deleted_resource)
+    else:
+        with get_run_metrics().stage('diff_policies'):
+            changed_policies, deleted_resources = diff_policy_snapshot(
+                state, all_iam_policies)
+        if (search_scopes is not None and search_scopes.failed_scopes and
+                deleted_resources):
+            print(f"Keeping {len(deleted_resources)} policies that weren't "
+                  "found, some of the searches failed")
+            deleted_resources = []
+    with get_run_metrics().stage('apply_changes'):
+        affected = apply_policy_changes(state, changed_policies,
+                                        deleted_resources, sa_index, gcp_org_id,
+                                        analysis_workers)
+    print(f"Applied {len(changed_policies)} changed and "
+          f"{len(deleted_resources)} deleted policies, "
+          f"{len(affected)} principals updated")
+    with get_run_metrics().stage('save_state'):
+        save_incremental_state(state, state_location)
+    with get_run_metrics().stage('write'):
+        write_results(iter_incremental_state_rows(state), csv_filename,
+                      output_format)
 
 
 def cf_entry_event(event, context):
@@ -400,16 +3263,32 @@ def cf_entry_event(event, context):
         """This Function was triggered by messageId {} published at {} to {}""".
         format(context.event_id, context.timestamp, context.resource["name"]))
 
+    temporal_asset = None
+    invalidate_principals = None
     if 'data' in event:
         data = base64.b64decode(event['data']).decode('utf-8')
         print(f"data received from trigger: {data}")
+        ## Messages published by a Cloud Asset feed carry the changed asset
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and 'asset' in payload:
+            temporal_asset = payload
+        ## Whatever watches the group memberships can ask for the
+        # changed members to be dropped from the analysis cache
+        if isinstance(payload, dict) and 'invalidatePrincipals' in payload:
+            invalidate_principals = payload['invalidatePrincipals']
 
     try:
-        run_remote()
-        return "Remote mode finished successfully"
+        with instrumented_run('cf_entry_event', os.getenv("PROFILE_OUTPUT")):
+            finished = run_remote(temporal_asset, invalidate_principals)
     except:
-        print("Remote mode failed")
+        print(f"Remote mode failed: {sys.exc_info()[1]!r}")
         exit(0)
+    if not finished:
+        return "Remote mode stopped at the time limit, the next run resumes it"
+    return "Remote mode finished successfully"
 
 
 def cf_entry_http(request):
@@ -420,44 +3299,317 @@ def cf_entry_http(request):
     #     data = base64.b64decode(event['data']).decode('utf-8')
     #     print(f"data received from trigger: {data}")
     try:
-        run_remote()
-        return "Remote mode finished successfully"
+        with instrumented_run('cf_entry_http', os.getenv("PROFILE_OUTPUT")):
+            finished = run_remote()
     except:
-        print("Remote mode failed")
+        print(f"Remote mode failed: {sys.exc_info()[1]!r}")
         exit(0)
+    if not finished:
+        return "Remote mode stopped at the time limit, the next run resumes it"
+    return "Remote mode finished successfully"
 
 
-def run_local(iam_json_filename, sas_json_filename, csv_filename, gcs_bucket):
+def run_local(iam_json_filename,
+              sas_json_filename,
+              csv_filename,
+              gcs_bucket,
+              stream=False,
+              workers=1,
+              output_format='csv',
+              profile_location=None,
+              analysis_file=None,
+              asset_filters=DEFAULT_ASSET_FILTERS):
     """
-    Execute the script in local mode, this expect json files to be passed in
+    Execute the script in local mode, this expect json files to be passed in.
+    With more than one worker the policies are parsed by a pool of processes.
+    The run metrics are logged at the end, and the run is profiled if a
+    profile location is passed. If an org wide analysis export is passed
+    the users get the entitlements from it, like in remote mode
     """
     print('Script running in local mode')
-    ## We are in local mode, read in local json files
-    all_iam_policies = import_json_as_dictionary(iam_json_filename)
-    all_svc_accts = import_json_as_dictionary(sas_json_filename)
+    with instrumented_run('run_local', profile_location), \
+            loaded_org_analysis(analysis_file):
+        ## We are in local mode, read in local json files,
+        # they are parsed as they are read, one record at a time
+        all_iam_policies = filter_iam_policies(
+            map(policy_record_from_dict, iter_json_records(iam_json_filename)),
+            asset_filters)
+        all_svc_accts = (sa_record for sa_record in map(
+            sa_record_from_dict, iter_json_records(sas_json_filename))
+                         if sa_record is not None)
+
+        metrics = get_run_metrics()
+        if stream and workers <= 1:
+            ## The rows are parsed as they are written out
+            with metrics.stage('stream'):
+                write_results(
+                    stream_assets_output(all_iam_policies, all_svc_accts),
+                    csv_filename, output_format)
+        else:
+            with metrics.stage('parse'):
+                if workers > 1:
+                    principal_policies = parse_assets_output_parallel(
+                        iam_json_filename, all_svc_accts, workers,
+                        asset_filters).values()
+                else:
+                    principal_policies = parse_assets_output(
+                        all_iam_policies, all_svc_accts).values()
+            with metrics.stage('write'):
+                write_results(principal_policies, csv_filename, output_format)
+        print(f"Wrote results to {csv_filename}")
+
+        if gcs_bucket:
+            with metrics.stage('upload'):
+                upload_file_gcp_bucket(gcs_bucket, csv_filename, csv_filename)
+            print(f"Uploaded file {csv_filename} to {gcs_bucket}")
+
+
+def run_local_incremental(iam_json_filename,
+                          previous_iam_json_filename,
+                          sas_json_filename,
+                          csv_filename,
+                          state_location,
+                          gcs_bucket,
+                          output_format='csv',
+                          profile_location=None,
+                          analysis_file=None,
+                          asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Execute the script in local incremental mode, only the policies that
+    changed since the saved state (or the previous export) are processed
+    """
+    print('Script running in local incremental mode')
+    with instrumented_run('run_local_incremental', profile_location), \
+            loaded_org_analysis(analysis_file):
+        all_iam_policies = filter_iam_policies(
+            map(policy_record_from_dict, iter_json_records(iam_json_filename)),
+            asset_filters)
+        all_svc_accts = (sa_record for sa_record in map(
+            sa_record_from_dict, iter_json_records(sas_json_filename))
+                         if sa_record is not None)
+        previous_iam_policies = None
+        if previous_iam_json_filename:
+            previous_iam_policies = filter_iam_policies(
+                map(policy_record_from_dict,
+                    iter_json_records(previous_iam_json_filename)),
+                asset_filters)
 
-    ## Write out CSV from the Dictionary
-    merged_iam_sa_dictionary = parse_assets_output(all_iam_policies,
-                                                   all_svc_accts)
-    write_dictionary_to_csv(merged_iam_sa_dictionary, csv_filename)
-    print(f"Wrote results to {csv_filename}")
+        run_incremental(state_location,
+                        all_iam_policies,
+                        all_svc_accts,
+                        csv_filename,
+                        previous_iam_policies,
+                        output_format=output_format,
+                        asset_filters=asset_filters)
+        print(f"Wrote results to {csv_filename}")
 
-    if gcs_bucket:
-        upload_file_gcp_bucket(gcs_bucket, csv_filename, csv_filename)
-        print(f"Uploaded file {csv_filename} to {gcs_bucket}")
+        if gcs_bucket:
+            with get_run_metrics().stage('upload'):
+                upload_file_gcp_bucket(gcs_bucket, csv_filename, csv_filename)
+            print(f"Uploaded file {csv_filename} to {gcs_bucket}")
 
 
-def run_remote():
+@contextlib.contextmanager
+def loaded_org_analysis(location):
     """
-    Execute the script in remote mode, this gets the data using APIs
+    Load an org wide analysis export for the duration of the block, does
+    nothing if no location is passed
+    """
+    if not location:
+        yield None
+        return
+    previous = set_org_analysis(load_org_analysis(location))
+    try:
+        yield get_org_analysis()
+    finally:
+        set_org_analysis(previous)
+
+
+def open_analysis_cache(invalidate_principals=None):
+    """
+    Open the analysis cache configured with the ANALYSIS_CACHE env var and
+    make it the one in use, returns None if caching is turned off. The
+    principals passed in, or listed in the ANALYSIS_CACHE_INVALIDATE env var
+    ('all' drops the whole cache), are removed from the cache first
+    """
+    if not os.getenv("ANALYSIS_CACHE"):
+        return None
+    analysis_cache = AnalysisCache(
+        os.getenv("ANALYSIS_CACHE"),
+        ttl=int(os.getenv("ANALYSIS_CACHE_TTL", str(ANALYSIS_CACHE_TTL))),
+        max_entries=int(
+            os.getenv("ANALYSIS_CACHE_MAX_ENTRIES",
+                      str(ANALYSIS_CACHE_MAX_ENTRIES))))
+    invalidate_principals = list(invalidate_principals or [])
+    if os.getenv("ANALYSIS_CACHE_INVALIDATE"):
+        invalidate_principals.extend(
+            principal.strip()
+            for principal in os.getenv("ANALYSIS_CACHE_INVALIDATE").split(','))
+    if 'all' in invalidate_principals:
+        removed = analysis_cache.invalidate()
+    elif invalidate_principals:
+        removed = analysis_cache.invalidate(invalidate_principals)
+    if invalidate_principals:
+        print(f"Removed {removed} entries from the analysis cache")
+    set_analysis_cache(analysis_cache)
+    return analysis_cache
+
+
+@contextlib.contextmanager
+def run_checkpoint(settings):
+    """
+    Checkpoint the run in the location set in the CHECKPOINT env var, if
+    any, picking up the progress of an earlier run with the same settings.
+    The progress is saved if the run fails or is stopped at the time limit
+    and removed once the run is done. Yields the RunCheckpoint or None
+    """
+    if not os.getenv("CHECKPOINT"):
+        yield None
+        return
+    fingerprint = hashlib.sha256(
+        json.dumps(settings).encode('utf-8')).hexdigest()
+    time_limit = os.getenv("CHECKPOINT_TIME_LIMIT")
+    checkpoint = RunCheckpoint(
+        os.getenv("CHECKPOINT"),
+        fingerprint,
+        interval=int(os.getenv("CHECKPOINT_INTERVAL",
+                               str(CHECKPOINT_INTERVAL))),
+        time_limit=int(time_limit) if time_limit else None)
+    checkpoint.load()
+    set_run_checkpoint(checkpoint)
+    try:
+        yield checkpoint
+    except CheckpointTimeLimit:
+        checkpoint.save()
+        raise
+    except BaseException:
+        checkpoint.save()
+        print(f"Saved the progress of the run to {checkpoint.location}")
+        raise
+    else:
+        checkpoint.clear()
+    finally:
+        set_run_checkpoint(None)
+
+
+## Default number of orgs collected at once in batch mode
+BATCH_CONCURRENCY = 4
+
+
+def batch_output_location(output_location, org_id):
+    """
+    The output location of an org in batch mode, the org id is added as a
+    folder in front of the file name
+    """
+    folder, _, filename = output_location.rpartition('/')
+    return f"{folder}/{org_id}/{filename}"
+
+
+def run_batch(gcp_org_ids,
+              output_location,
+              output_format='csv',
+              asset_filters=DEFAULT_ASSET_FILTERS,
+              scope_mode='org',
+              scope_concurrency=SCOPE_CONCURRENCY,
+              analysis_workers=ANALYSIS_CONCURRENCY,
+              max_orgs=BATCH_CONCURRENCY):
+    """
+    Collect the inventory of several orgs, max_orgs at a time, sharing the
+    clients, the analysis cache and the API quota. The results of each org
+    are written to batch_output_location and all of them, merged, to the
+    output location. An org that fails is logged and left out of the
+    merged results, the run only stops if every org failed. Returns the
+    orgs that failed
+    """
+    metrics = get_run_metrics()
+
+    def collect(org_id):
+        search_scopes = SearchScopes(org_id, scope_mode, scope_concurrency)
+        with metrics.stage(f"org {org_id}"):
+            principal_policies = parse_assets_output(
+                get_all_iam_policies(org_id, asset_filters, search_scopes),
+                get_all_sas(org_id, asset_filters, search_scopes), org_id,
+                analysis_workers)
+            write_results(principal_policies.values(),
+                          batch_output_location(output_location, org_id),
+                          output_format)
+        return principal_policies, search_scopes
+
+    combined = EntitlementAccumulator()
+    failed_orgs = []
+    with ThreadPoolExecutor(max_workers=max(1, max_orgs)) as executor:
+        ## The orgs are merged in the order they were passed in, so the
+        # merged results don't depend on which org finishes first
+        futures = deque((org_id, executor.submit(collect, org_id))
+                        for org_id in gcp_org_ids)
+        while futures:
+            org_id, future = futures.popleft()
+            try:
+                principal_policies, search_scopes = future.result()
+            ## The exit(0) of a failed fetch only ends the org
+            except (Exception, SystemExit) as err:
+                reason = '' if isinstance(err, SystemExit) else f": {err!r}"
+                print(f"Collecting the inventory of org {org_id} failed, "
+                      f"continuing without it{reason}")
+                failed_orgs.append(org_id)
+                continue
+            if search_scopes.summary() is not None:
+                print(f"org {org_id}: {search_scopes.summary()}")
+            print(f"Wrote the results of org {org_id} to "
+                  f"{batch_output_location(output_location, org_id)}")
+            combined.merge(principal_policies)
+    if len(failed_orgs) == len(gcp_org_ids):
+        print("Collecting the inventory failed for every org")
+        exit(0)
+    with metrics.stage('write'):
+        write_results(combined.values(), output_location, output_format)
+    if failed_orgs:
+        print(f"{len(failed_orgs)} of {len(gcp_org_ids)} orgs failed, the "
+              f"merged results are incomplete: {', '.join(failed_orgs)}")
+    return failed_orgs
+
+
+def api_quota_from_env():
+    """
+    Create the API quota set with the API_QPS and ORG_API_QPS env vars,
+    None if neither is set
+    """
+    qps = float(os.getenv("API_QPS", "0"))
+    org_qps = float(os.getenv("ORG_API_QPS", "0"))
+    if not qps and not org_qps:
+        return None
+    return ApiQuota(qps or None, org_qps or None)
+
+
+def run_remote(temporal_asset=None,
+               invalidate_principals=None,
+               profile_location=None):
+    """
+    Execute the script in remote mode, this gets the data using APIs. If
+    the run was triggered by a Cloud Asset feed and incremental mode is on,
+    only the changed asset is processed. The principals passed in are
+    removed from the analysis cache before the run. The run metrics are
+    logged at the end, and the run is profiled if a profile location is
+    passed or set in the PROFILE_OUTPUT env var. Returns False if the run
+    stopped at the checkpoint time limit before writing the results
     """
     print('Script running in remote mode')
-    if os.getenv("GCP_ORG_ID"):
-        gcp_org_id = os.getenv("GCP_ORG_ID")
+    if os.getenv("GCP_ORG_IDS"):
+        gcp_org_ids = [
+            org_id.strip()
+            for org_id in os.getenv("GCP_ORG_IDS").split(',')
+            if org_id.strip()
+        ]
+    elif os.getenv("GCP_ORG_ID"):
+        gcp_org_ids = [os.getenv("GCP_ORG_ID")]
     else:
+        gcp_org_ids = []
+    if not gcp_org_ids:
         print("Pass in GCP ORG ID by setting an env var " +
-              "called 'GCP_ORG_ID'")
+              "called 'GCP_ORG_ID' (or a comma separated list of them " +
+              "in 'GCP_ORG_IDS')")
         exit(0)
+    gcp_org_id = gcp_org_ids[0]
     if os.getenv("GCS_BUCKET_NAME"):
         gcs_bucket = os.getenv("GCS_BUCKET_NAME")
     else:
@@ -472,15 +3624,499 @@ def run_remote():
               "called 'CSV_OUTPUT_FILE'")
         exit(0)
 
-    all_iam_policies = get_all_iam_policies(gcp_org_id)
-    all_svc_accts = get_all_sas(gcp_org_id)
-    merged_iam_sa_dictionary = parse_assets_output(all_iam_policies,
-                                                   all_svc_accts, gcp_org_id)
-    csv_file_full_path = f"/tmp/{csv_filename}"
-    write_dictionary_to_csv(merged_iam_sa_dictionary, csv_file_full_path)
-    print(f"Wrote results to {csv_file_full_path}")
-    upload_file_gcp_bucket(gcs_bucket, csv_filename, csv_file_full_path)
-    print(f"Uploaded file {csv_file_full_path} to {gcs_bucket}")
+    analysis_workers = int(
+        os.getenv("ANALYSIS_CONCURRENCY", str(ANALYSIS_CONCURRENCY)))
+
+    ## Stream the results straight into the bucket, nothing is
+    # staged in the (memory backed) /tmp of the cloud function
+    csv_file_full_path = f"gs://{gcs_bucket}/{csv_filename}"
+    output_format = os.getenv("OUTPUT_FORMAT", "csv")
+    if profile_location is None:
+        profile_location = os.getenv("PROFILE_OUTPUT")
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Unknown output format '{output_format}' in the env var " +
+              f"called 'OUTPUT_FORMAT', use one of {', '.join(OUTPUT_FORMATS)}")
+        exit(0)
+    analysis_mode = os.getenv("ANALYSIS_MODE", "per_user")
+    if analysis_mode not in ANALYSIS_MODES:
+        print(f"Unknown analysis mode '{analysis_mode}' in the env var " +
+              f"called 'ANALYSIS_MODE', use one of {', '.join(ANALYSIS_MODES)}")
+        exit(0)
+    asset_filters = asset_filters_from_strings(os.getenv("INCLUDE_ASSET_TYPES"),
+                                               os.getenv("EXCLUDE_ASSET_TYPES"),
+                                               os.getenv("MEMBER_TYPES"),
+                                               os.getenv("EXCLUDE_NAMES"))
+    scope_mode = os.getenv("SCOPE_MODE", "org")
+    if scope_mode not in SCOPE_MODES:
+        print(f"Unknown scope mode '{scope_mode}' in the env var " +
+              f"called 'SCOPE_MODE', use one of {', '.join(SCOPE_MODES)}")
+        exit(0)
+    scope_concurrency = int(
+        os.getenv("SCOPE_CONCURRENCY", str(SCOPE_CONCURRENCY)))
+    search_scopes = SearchScopes(gcp_org_id, scope_mode, scope_concurrency)
+    batch = len(gcp_org_ids) > 1
+    if batch and analysis_mode != 'per_user':
+        print("Batch mode (more than one org in 'GCP_ORG_IDS') only " +
+              "supports the per_user analysis mode")
+        exit(0)
+    if analysis_mode == 'org_export' and os.getenv("INCREMENTAL_STATE"):
+        print("Incremental mode (the env var called 'INCREMENTAL_STATE') " +
+              "doesn't support the org_export analysis mode, every feed " +
+              "update would export the whole org")
+        exit(0)
+    if batch:
+        for env_var in ("INCREMENTAL_STATE", "STREAMING_MODE", "CHECKPOINT"):
+            if os.getenv(env_var, "false").lower() not in ("", "false"):
+                print(f"Ignoring the env var called '{env_var}', it's not " +
+                      "used in batch mode")
+    analysis_location = os.getenv(
+        "ANALYSIS_EXPORT_URI", f"gs://{gcs_bucket}/iam-policy-analysis.json")
+
+    def prepare_org_analysis(checkpoint=None):
+        """
+        In org_export mode run one long running analysis of the whole org
+        instead of one analyze_iam_policy call per user, unless the
+        checkpoint says an earlier run already exported it
+        """
+        if analysis_mode != 'org_export':
+            return
+        if checkpoint is not None and (checkpoint.org_export
+                                       == analysis_location):
+            print("Reusing the org wide analysis exported to " +
+                  f"{analysis_location} by an earlier run")
+        else:
+            export_org_analysis(
+                gcp_org_id, analysis_location,
+                int(
+                    os.getenv("ANALYSIS_EXPORT_TIMEOUT",
+                              str(ANALYSIS_EXPORT_TIMEOUT))))
+            if checkpoint is not None:
+                checkpoint.set_org_export(analysis_location)
+        set_org_analysis(load_org_analysis(analysis_location))
+
+    previous_quota = set_api_quota(api_quota_from_env())
+    with instrumented_run('run_remote', profile_location):
+        analysis_cache = open_analysis_cache(invalidate_principals)
+        if os.getenv("CHECKPOINT") and not batch and (
+                os.getenv("INCREMENTAL_STATE") or
+                os.getenv("STREAMING_MODE", "false").lower() == "true"):
+            print("Ignoring the env var called 'CHECKPOINT', it's not " +
+                  "used in incremental or streaming mode")
+        try:
+            if batch:
+                run_batch(gcp_org_ids,
+                          csv_file_full_path,
+                          output_format,
+                          asset_filters,
+                          scope_mode,
+                          scope_concurrency,
+                          analysis_workers,
+                          max_orgs=int(
+                              os.getenv("BATCH_CONCURRENCY",
+                                        str(BATCH_CONCURRENCY))))
+            elif os.getenv("INCREMENTAL_STATE"):
+                ## The policies are only fetched if there is no feed update
+                # to apply, or no state to apply it to
+                temporal_assets = [temporal_asset] if temporal_asset else None
+                run_incremental(os.getenv("INCREMENTAL_STATE"),
+                                iter_all_iam_policies(gcp_org_id, asset_filters,
+                                                      search_scopes),
+                                iter_all_sas(gcp_org_id, asset_filters,
+                                             search_scopes),
+                                csv_file_full_path,
+                                temporal_assets=temporal_assets,
+                                gcp_org_id=gcp_org_id,
+                                analysis_workers=analysis_workers,
+                                output_format=output_format,
+                                asset_filters=asset_filters,
+                                search_scopes=search_scopes)
+            elif os.getenv("STREAMING_MODE", "false").lower() == "true":
+                ## Pull the result pages lazily and write each row as soon as
+                # it's final instead of holding the whole inventory in memory
+                prepare_org_analysis()
+                principal_policies = stream_assets_output(
+                    iter_all_iam_policies(gcp_org_id, asset_filters,
+                                          search_scopes),
+                    iter_all_sas(gcp_org_id, asset_filters, search_scopes),
+                    gcp_org_id, analysis_workers)
+                with get_run_metrics().stage('stream'):
+                    write_results(principal_policies, csv_file_full_path,
+                                  output_format)
+            else:
+                metrics = get_run_metrics()
+                ## The progress is saved along the way, so a failed or
+                # stopped run can be picked up by the next one
+                with run_checkpoint(
+                    [gcp_org_id, scope_mode, asset_filters,
+                     analysis_mode]) as checkpoint:
+                    prepare_org_analysis(checkpoint)
+                    with metrics.stage('fetch_iam_policies'):
+                        all_iam_policies = get_all_iam_policies(
+                            gcp_org_id, asset_filters, search_scopes)
+                    with metrics.stage('fetch_service_accounts'):
+                        all_svc_accts = get_all_sas(gcp_org_id, asset_filters,
+                                                    search_scopes)
+                    with metrics.stage('parse'):
+                        merged_iam_sa_dictionary = parse_assets_output(
+                            all_iam_policies, all_svc_accts, gcp_org_id,
+                            analysis_workers)
+                    with metrics.stage('write'):
+                        write_results(merged_iam_sa_dictionary.values(),
+                                      csv_file_full_path, output_format)
+        except CheckpointTimeLimit as err:
+            print(err)
+            return False
+        finally:
+            set_org_analysis(None)
+            set_api_quota(previous_quota)
+            if analysis_cache is not None:
+                set_analysis_cache(None)
+                print(analysis_cache.summary())
+                analysis_cache.close()
+        if search_scopes.summary() is not None:
+            print(search_scopes.summary())
+        print(f"Wrote results to {csv_file_full_path}")
+    return True
+
+
+## How often the service reloads the inventory in seconds
+SERVICE_REFRESH_INTERVAL = 60 * 60
+
+SERVICE_PORT = 8080
+
+## Columns of an entitlement in the query results
+ENTITLEMENT_COLUMNS = ('Role', 'Resource_Type', 'Resource_Name', 'Via')
+
+
+def entitlement_to_dict(entitlement):
+    """
+    Turn an EntitlementRecord into a dictionary with the
+    ENTITLEMENT_COLUMNS as keys
+    """
+    return dict(zip(ENTITLEMENT_COLUMNS, entitlement))
+
+
+class InventoryIndex:
+    """
+    The principal policies of one load of the inventory with the indexes
+    the queries are answered from: the principals by email (the
+    EntitlementAccumulator itself) and the grants, an entitlement with the
+    emails of the principals that have it, by role and by resource name.
+    An index is never changed once it's built, a refresh builds a new one
+    """
+
+    def __init__(self, principal_policies):
+        self.principal_policies = principal_policies
+        self.loaded_at = time.time()
+        self.by_role = {}
+        self.by_resource = {}
+        grants = principal_policies.entitlement_principals().items()
+        for entitlement, emails in grants:
+            self.by_role.setdefault(entitlement.role, []).append(
+                (entitlement, emails))
+            self.by_resource.setdefault(entitlement.resource_name, []).append(
+                (entitlement, emails))
+        self.entitlements = len(grants)
+
+    def principal(self, email):
+        """
+        Return the principal policy of a principal with its entitlements as
+        dictionaries, None if the principal has no entitlements
+        """
+        principal_policy = self.principal_policies.get(email)
+        if principal_policy is None:
+            return None
+        return dict(principal_policy,
+                    Entitlement=list(
+                        map(entitlement_to_dict,
+                            principal_policy['Entitlement'])))
+
+    def grants(self, role=None, resource=None):
+        """
+        Return the principals with a role, on a resource or both, one
+        dictionary per principal and entitlement. The role can be passed
+        with or without the roles/ prefix and the resource by its name or
+        its full resource name, like they are matched when parsing
+        """
+        if role is not None:
+            role = role.replace('roles/', '')
+        if resource is not None:
+            resource = resource.split('/')[-1]
+            grants = self.by_resource.get(resource, ())
+            if role is not None:
+                grants = [(entitlement, emails)
+                          for entitlement, emails in grants
+                          if entitlement.role == role]
+        else:
+            grants = self.by_role.get(role, ())
+        return [
+            dict(entitlement_to_dict(entitlement), Email=email)
+            for entitlement, emails in grants
+            for email in emails
+        ]
+
+
+class InventoryService:
+    """
+    Keep an InventoryIndex warm in memory and answer the queries from it.
+    The inventory is loaded with the load function (which returns an
+    EntitlementAccumulator) when the service starts and reloaded in a
+    background thread every refresh_interval seconds or when a refresh is
+    requested. The queries are answered from the current index while a
+    new one is built. If a version function is passed the reload is
+    skipped as long as it returns the version that was loaded last. A
+    failed reload is logged and the previous index is kept
+    """
+
+    def __init__(self,
+                 load,
+                 refresh_interval=SERVICE_REFRESH_INTERVAL,
+                 version=None):
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.version = version
+        self.index = None
+        self.refreshes = 0
+        self.last_error = None
+        self._loaded_version = None
+        self._force_refresh = False
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh(self, force=False):
+        """
+        Reload the inventory and swap in the new index, returns False if
+        the inputs didn't change since the last load
+        """
+        with self._refresh_lock:
+            version = self.version() if self.version is not None else None
+            if (not force and self.index is not None and version is not None and
+                    version == self._loaded_version):
+                return False
+            with instrumented_run('refresh_inventory'):
+                index = InventoryIndex(self.load())
+            self.index = index
+            self._loaded_version = version
+            self.refreshes += 1
+            self.last_error = None
+        print(f"Loaded {len(index.principal_policies)} principals with "
+              f"{index.entitlements} entitlements")
+        return True
+
+    def start(self):
+        """
+        Load the inventory and start the background refreshes
+        """
+        self.refresh(force=True)
+        self._thread = threading.Thread(target=self._refresh_loop,
+                                        name='inventory-refresh',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background refreshes, waits for a running one to finish
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def request_refresh(self):
+        """
+        Reload the inventory in the background now
+        """
+        self._force_refresh = True
+        self._wake.set()
+
+    def _refresh_loop(self):
+        while True:
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+            force, self._force_refresh = self._force_refresh, False
+            try:
+                self.refresh(force)
+            ## The exit(0) of a failed fetch only ends the reload
+            except (Exception, SystemExit) as err:
+                self.last_error = repr(err)
+                print(f"Refreshing the inventory failed, the previous one is "
+                      f"kept: {err!r}")
+
+    def status(self):
+        """
+        Return the state of the service
+        """
+        index = self.index
+        return {
+            'loaded_at': index.loaded_at if index else None,
+            'principals': len(index.principal_policies) if index else 0,
+            'entitlements': index.entitlements if index else 0,
+            'refreshes': self.refreshes,
+            'last_error': self.last_error
+        }
+
+    def query(self, path, params):
+        """
+        Answer a query, returns the http status and the json payload.
+        GET /principals/<email> returns the entitlements of a principal,
+        GET /principals?role=<role>&resource=<resource> the principals
+        with a role and/or on a resource and GET /status the state of the
+        service
+        """
+        index = self.index
+        if path == '/status':
+            return 200, self.status()
+        if path.startswith('/principals/'):
+            email = unquote(path[len('/principals/'):])
+            principal_policy = index.principal(email)
+            if principal_policy is None:
+                return 404, {'error': f"No entitlements found for {email}"}
+            return 200, principal_policy
+        if path == '/principals':
+            if not params.get('role') and not params.get('resource'):
+                return 400, {'error': "Pass a role, a resource or both"}
+            return 200, index.grants(params.get('role'), params.get('resource'))
+        return 404, {'error': f"Unknown path {path}"}
+
+
+def make_query_handler(service):
+    """
+    Create the http request handler of an InventoryService
+    """
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        """
+        Answer GET queries from the service, POST /refresh reloads the
+        inventory in the background
+        """
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {
+                name: values[0] for name, values in parse_qs(url.query).items()
+            }
+            self._send_json(*service.query(url.path, params))
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/refresh':
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            service.request_refresh()
+            self._send_json(202, {'refresh': 'started'})
+
+    return QueryHandler
+
+
+def local_inventory_loader(iam_json_filename,
+                           sas_json_filename,
+                           analysis_file=None,
+                           asset_filters=DEFAULT_ASSET_FILTERS):
+    """
+    Return the load and version functions of an InventoryService that
+    reads the json files run_local reads. The version is the modification
+    time and size of the local files, gs:// files are always reloaded
+    """
+
+    def load():
+        with loaded_org_analysis(analysis_file):
+            return parse_assets_output(
+                filter_iam_policies(
+                    map(policy_record_from_dict,
+                        iter_json_records(iam_json_filename)), asset_filters),
+                (sa_record for sa_record in map(
+                    sa_record_from_dict, iter_json_records(sas_json_filename))
+                 if sa_record is not None))
+
+    def version():
+        filenames = [iam_json_filename, sas_json_filename]
+        if analysis_file:
+            filenames.append(analysis_file)
+        if any(filename.startswith('gs://') for filename in filenames):
+            return None
+        return [(os.stat(filename).st_mtime_ns, os.stat(filename).st_size)
+                for filename in filenames]
+
+    return load, version
+
+
+def remote_inventory_loader():
+    """
+    Return the load function of an InventoryService that fetches the
+    inventory through the APIs, configured with the env vars run_remote
+    reads. The users are analyzed with analyze_iam_policy
+    """
+    if os.getenv("GCP_ORG_ID"):
+        gcp_org_id = os.getenv("GCP_ORG_ID")
+    else:
+        print("Pass in GCP ORG ID by setting an env var " +
+              "called 'GCP_ORG_ID'")
+        exit(0)
+    analysis_workers = int(
+        os.getenv("ANALYSIS_CONCURRENCY", str(ANALYSIS_CONCURRENCY)))
+    asset_filters = asset_filters_from_strings(os.getenv("INCLUDE_ASSET_TYPES"),
+                                               os.getenv("EXCLUDE_ASSET_TYPES"),
+                                               os.getenv("MEMBER_TYPES"),
+                                               os.getenv("EXCLUDE_NAMES"))
+    scope_mode = os.getenv("SCOPE_MODE", "org")
+    if scope_mode not in SCOPE_MODES:
+        print(f"Unknown scope mode '{scope_mode}' in the env var " +
+              f"called 'SCOPE_MODE', use one of {', '.join(SCOPE_MODES)}")
+        exit(0)
+    scope_concurrency = int(
+        os.getenv("SCOPE_CONCURRENCY", str(SCOPE_CONCURRENCY)))
+
+    def load():
+        search_scopes = SearchScopes(gcp_org_id, scope_mode, scope_concurrency)
+        principal_policies = parse_assets_output(
+            get_all_iam_policies(gcp_org_id, asset_filters, search_scopes),
+            get_all_sas(gcp_org_id, asset_filters, search_scopes), gcp_org_id,
+            analysis_workers)
+        if search_scopes.summary() is not None:
+            print(search_scopes.summary())
+        return principal_policies
+
+    return load
+
+
+def run_service(load,
+                version=None,
+                host='127.0.0.1',
+                port=SERVICE_PORT,
+                refresh_interval=SERVICE_REFRESH_INTERVAL):
+    """
+    Execute the script in service mode, the inventory is kept in memory
+    and refreshed in the background and the queries are answered over http
+    until the process is stopped
+    """
+    print('Script running in service mode')
+    service = InventoryService(load, refresh_interval, version)
+    service.start()
+    server = ThreadingHTTPServer((host, port), make_query_handler(service))
+    print(f"Answering queries on http://{host}:{server.server_port}")
+    ## Shut down cleanly when the platform stops the process, the server
+    # has to be shut down from another thread than the one serving
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
 
 
 if __name__ == "__main__":
@@ -513,6 +4149,13 @@ if __name__ == "__main__":
         dest='mode',
         const='local',
         help='run in local mode reading from passed in json files')
+    group.add_argument(
+        '--serve',
+        action='store_const',
+        dest='mode',
+        const='serve',
+        help='keep the inventory in memory and answer queries over http, '
+        'from the passed in json files or else from the apis')
     parser.set_defaults(mode='remote')
     parser.add_argument('-g',
                         '--gcs_bucket',
@@ -528,7 +4171,76 @@ if __name__ == "__main__":
     parser.add_argument('-o',
                         '--output_file',
                         help='name of file to write results to')
+    parser.add_argument(
+        '--previous_iam_file',
+        help='file containing the iam policies of a previous export, used as '
+        'the starting point of the incremental state (only in local mode)')
+    parser.add_argument(
+        '--state_file',
+        help='incremental state file (local path or gs://bucket/object), '
+        'only the policies that changed since it was saved are processed '
+        '(only in local mode)')
+    parser.add_argument('-f',
+                        '--output_format',
+                        choices=OUTPUT_FORMATS,
+                        default='csv',
+                        help='format of the results file, parquet and jsonl '
+                        'have one row per principal and entitlement '
+                        '(default csv)')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes used to parse the iam policies '
+        '(only in local mode, default 1)')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='write each row as soon as it is final instead of building '
+        'all the results in memory first (only in local mode)')
+    parser.add_argument(
+        '-a',
+        '--analysis_file',
+        help='result of an org wide iam policy analysis (local path or '
+        'gs://bucket/object), the users get their entitlements, including '
+        'the ones inherited from groups, from it (only in local mode)')
+    parser.add_argument(
+        '--include_asset_types',
+        help='comma separated asset types, only the policies attached to '
+        'them are reported on (only in local mode)')
+    parser.add_argument(
+        '--exclude_asset_types',
+        help='comma separated asset types whose policies are skipped '
+        '(default orgpolicy.googleapis.com/Policy, only in local mode)')
+    parser.add_argument(
+        '--member_types',
+        help='comma separated member types to report on, for example '
+        'user,serviceAccount (default all, only in local mode)')
+    parser.add_argument(
+        '--profile',
+        help='profile the run with cProfile and write the stats to this '
+        'file (local path or gs://bucket/object)')
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='address to listen on (only in service mode, '
+                        'default 127.0.0.1)')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=int(os.getenv("PORT", str(SERVICE_PORT))),
+        help='port to listen on (only in service mode, default the PORT '
+        f'env var or {SERVICE_PORT})')
+    parser.add_argument(
+        '--refresh_interval',
+        type=int,
+        default=SERVICE_REFRESH_INTERVAL,
+        help='seconds between the reloads of the inventory (only in service '
+        f'mode, default {SERVICE_REFRESH_INTERVAL})')
     args = parser.parse_args()
+    ASSET_FILTERS = asset_filters_from_strings(args.include_asset_types,
+                                               args.exclude_asset_types,
+                                               args.member_types)
 
     ## If --remote is passed ignore the local variables
     if args.mode == 'remote' and (args.iam_file or args.sas_file):
@@ -537,7 +4249,36 @@ if __name__ == "__main__":
         exit(0)
 
     if args.mode == 'remote':
-        run_remote()
+        run_remote(profile_location=args.profile)
+
+    if args.mode == 'serve':
+        if bool(args.iam_file) != bool(args.sas_file):
+            print("--serve needs both the iam file and the service accounts " +
+                  "file, or neither to read from the apis")
+            exit(0)
+        if args.iam_file:
+            LOAD, VERSION = local_inventory_loader(args.iam_file, args.sas_file,
+                                                   args.analysis_file,
+                                                   ASSET_FILTERS)
+            run_service(LOAD, VERSION, args.host, args.port,
+                        args.refresh_interval)
+        else:
+            ANALYSIS_CACHE = open_analysis_cache()
+            try:
+                run_service(remote_inventory_loader(),
+                            host=args.host,
+                            port=args.port,
+                            refresh_interval=args.refresh_interval)
+            finally:
+                if ANALYSIS_CACHE is not None:
+                    set_analysis_cache(None)
+                    ANALYSIS_CACHE.close()
+
+    if args.mode == 'local' and args.stream and args.workers > 1:
+        print("--stream can't be used with more than one worker (-w), " +
+              "the worker processes parse the whole export before the " +
+              "results are written")
+        exit(0)
 
     if args.mode == 'local':
         IAM_JSON_FILENAME = args.iam_file
@@ -545,10 +4286,33 @@ if __name__ == "__main__":
         if args.output_file:
             CSV_FILENAME = args.output_file
         else:
-            CSV_FILENAME = IAM_JSON_FILENAME.replace('json', 'csv')
+            ## Named after the policies file, with the extension of the
+            # output format
+            CSV_FILENAME = (os.path.splitext(IAM_JSON_FILENAME)[0] + '.' +
+                            args.output_format)
         if args.gcs_bucket:
             GCS_BUCKET = args.gcs_bucket
         else:
             GCS_BUCKET = ""
-        run_local(IAM_JSON_FILENAME, SAS_JSON_FILENAME, CSV_FILENAME,
-                  GCS_BUCKET)
+        if args.state_file:
+            run_local_incremental(IAM_JSON_FILENAME,
+                                  args.previous_iam_file,
+                                  SAS_JSON_FILENAME,
+                                  CSV_FILENAME,
+                                  args.state_file,
+                                  GCS_BUCKET,
+                                  output_format=args.output_format,
+                                  profile_location=args.profile,
+                                  analysis_file=args.analysis_file,
+                                  asset_filters=ASSET_FILTERS)
+        else:
+            run_local(IAM_JSON_FILENAME,
+                      SAS_JSON_FILENAME,
+                      CSV_FILENAME,
+                      GCS_BUCKET,
+                      stream=args.stream,
+                      workers=args.workers,
+                      output_format=args.output_format,
+                      profile_location=args.profile,
+                      analysis_file=args.analysis_file,
+                      asset_filters=ASSET_FILTERS)